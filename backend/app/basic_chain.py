@@ -1,25 +1,132 @@
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_openai import ChatOpenAI
+from pydantic import BaseModel, Field
+from typing import List, Optional, Tuple
+import asyncio
 import logging
 
+FALLBACK_TITLE = "Untitled Session"  # Formal fallback
+
+TITLE_PROMPT = ChatPromptTemplate.from_template(
+    """Generate a formal and concise title (3-6 words) for a professional chat session.
+    The title should reflect the initial message's intent without being too casual.
+    Initial message: {message}
+    Respond only with the title, no additional text."""
+)
+
+BATCH_TITLE_PROMPT = ChatPromptTemplate.from_template(
+    """Generate a formal and concise title (3-6 words) for each of the professional chat sessions below.
+    Each title should reflect its initial message's intent without being too casual.
+    Return exactly one title per message, using the message's number as its index.
+
+    {messages}"""
+)
+
+
+class SessionTitle(BaseModel):
+    index: int = Field(description="Number of the message this title belongs to")
+    title: str = Field(description="Title for the chat session")
+
+
+class SessionTitles(BaseModel):
+    titles: List[SessionTitle]
+
+
+def _clean_title(raw_title: Optional[str]) -> str:
+    title = (raw_title or "").strip().strip('"').strip()
+    if not title:
+        return FALLBACK_TITLE
+    if len(title.split()) > 5:  # Ensure conciseness
+        title = " ".join(title.split()[:5])
+    return title
+
+
+class TitleBatcher:
+    """
+    Collects title requests for a few milliseconds and generates all of their
+    titles with a single structured-output call, resolving each caller with its
+    own title (or the fallback title if that item is missing).
+    """
+
+    def __init__(
+        self,
+        model: str = "gpt-4o-mini",
+        max_batch_size: int = 32,
+        max_wait: float = 0.02,
+    ):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._llm = None
+        self._pending: List[Tuple[str, asyncio.Future]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+    @property
+    def llm(self):
+        if self._llm is None:
+            self._llm = ChatOpenAI(model=self.model, temperature=0.3)
+        return self._llm
+
+    async def generate(self, user_message: str) -> str:
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((user_message, future))
+
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_wait, self._flush)
+
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            asyncio.create_task(self._run_batch(batch))
+
+    async def _run_batch(self, batch: List[Tuple[str, asyncio.Future]]):
+        try:
+            if len(batch) == 1:
+                titles = [await self._generate_single(batch[0][0])]
+            else:
+                titles = await self._generate_many([message for message, _ in batch])
+        except Exception as e:
+            logging.error(f"Title generation failed for batch of {len(batch)}: {e}")
+            titles = [FALLBACK_TITLE] * len(batch)
+
+        for (_, future), title in zip(batch, titles):
+            if not future.done():
+                future.set_result(title)
+
+    async def _generate_single(self, user_message: str) -> str:
+        response = await (TITLE_PROMPT | self.llm).ainvoke({"message": user_message})
+        return _clean_title(response.content)
+
+    async def _generate_many(self, user_messages: List[str]) -> List[str]:
+        numbered = "\n".join(
+            f"{i}. {message}" for i, message in enumerate(user_messages, start=1)
+        )
+        chain = BATCH_TITLE_PROMPT | self.llm.with_structured_output(SessionTitles)
+        result = await chain.ainvoke({"messages": numbered})
+
+        by_index = {item.index: item.title for item in result.titles}
+        missing = len(user_messages) - sum(
+            1 for i in range(1, len(user_messages) + 1) if by_index.get(i)
+        )
+        if missing:
+            logging.warning(f"Title batch missing {missing}/{len(user_messages)} titles")
+        return [_clean_title(by_index.get(i)) for i in range(1, len(user_messages) + 1)]
+
+
+title_batcher = TitleBatcher()
+
+
 async def generate_chat_title(user_message: str) -> str:
     try:
-        title_prompt = ChatPromptTemplate.from_template(
-            """Generate a formal and concise title (3-6 words) for a professional chat session.
-            The title should reflect the initial message's intent without being too casual.
-            Initial message: {message}
-            Respond only with the title, no additional text."""
-        )
-        
-        llm = ChatOpenAI(model="gpt-4o-mini", temperature=0.3)  
-        chain = title_prompt | llm
-        response = await chain.ainvoke({"message": user_message})
-        
-        # Clean up the response
-        title = response.content.strip('"').strip()
-        if len(title.split()) > 5:  # Ensure conciseness
-            title = " ".join(title.split()[:5])
-        return title
+        return await title_batcher.generate(user_message)
     except Exception as e:
         logging.error(f"Title generation failed: {e}")
-        return "Untitled Session"  # Formal fallback
\ No newline at end of file
+        return FALLBACK_TITLE
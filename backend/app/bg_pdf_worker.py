@@ -7,6 +7,9 @@ from langchain_pinecone import PineconeVectorStore
 from langchain_voyageai import VoyageAIEmbeddings
 from langchain.schema import Document  # Import Document
 import os  # Import os for environment variable check
+import time
+from .metrics import observe, timed
+from .pinecone_retriever_chain import TimedEmbeddings
 
 # Configure logging
 logging.basicConfig(
@@ -21,7 +24,7 @@ if not os.getenv("VOYAGE_API_KEY"):
     # Depending on your application, you might want to exit or raise an error here.
     # For this example, we'll assume it's set for the embeddings to work.
 
-embeddings = VoyageAIEmbeddings(model="voyage-3")
+embeddings = TimedEmbeddings(VoyageAIEmbeddings(model="voyage-3"))
 
 
 # Keep this function - defines chunk_size and overlap.
@@ -56,7 +59,8 @@ async def process_pdf_worker(redis_instance):
             logging.info(
                 f"📦 Received task for PDF ID: {task['pdfId']}, User ID: {task['userId']}"
             )
-            await process_pdf_ingestion(task["pdfId"], task["userId"])
+            with timed("ingest_total"):
+                await process_pdf_ingestion(task["pdfId"], task["userId"])
             logging.info(
                 f"✅ PDF ingestion task completed for PDF ID: {task['pdfId']} and User ID: {task['userId']}"
             )
@@ -88,7 +92,8 @@ async def process_pdf_ingestion(pdf_id: str, user_id: str):
 
         # Download PDF as bytes
         try:
-            pdf_bytes = blob.download_as_bytes()
+            with timed("ingest_download"):
+                pdf_bytes = blob.download_as_bytes()
         except Exception as download_e:
             logging.error(
                 f"❌ Failed to download PDF {pdf_id} from Firebase Storage path {pdf_path}: {download_e}"
@@ -123,6 +128,7 @@ async def process_pdf_ingestion(pdf_id: str, user_id: str):
 
         # Process each page
         logging.info(f"Processing {doc.page_count} pages for PDF {pdf_id}...")
+        chunking_start = time.perf_counter()
         for page_index in range(doc.page_count):
             page = doc.load_page(page_index)
             page_text = page.get_text("text")
@@ -194,6 +200,7 @@ async def process_pdf_ingestion(pdf_id: str, user_id: str):
             )
 
         # End of page processing loop
+        observe("ingest_chunk", time.perf_counter() - chunking_start)
 
         if not all_documents:
             logging.warning(f"⚠ No valid text chunks found in the entire PDF {pdf_id}")
@@ -218,9 +225,10 @@ async def process_pdf_ingestion(pdf_id: str, user_id: str):
         )
         # PineconeVectorStore.from_documents handles batching internally.
         try:
-            PineconeVectorStore.from_documents(
-                all_documents, embeddings, index_name="versa-ai-voyage"
-            )
+            with timed("ingest_upsert"):
+                PineconeVectorStore.from_documents(
+                    all_documents, embeddings, index_name="versa-ai-voyage"
+                )
             logging.info(f"✅ PDF {pdf_id} successfully stored in Pinecone.")
         except Exception as pinecone_e:
             logging.error(
@@ -1,12 +1,323 @@
 import logging
 import asyncio
 import time
-import json
+from collections import defaultdict
 from google.cloud import firestore
+from redis.exceptions import ResponseError
+from .session_manager_firebase import (
+    DIRTY_STREAM_MAXLEN,
+    LAST_FLUSH_KEY,
+    MESSAGES_KEY,
+    META_KEY,
+    SESSION_CACHE_TTL_SECONDS,
+    unpack_message,
+)
+from .firestore_dal import FIRESTORE_MAX_BATCH_WRITES
+from .metrics import observe
+from .flush_coordinator import (
+    DIRTY_STREAM_KEY,
+    LEASE_TTL_SECONDS,
+    dirty_stream_key,
+)
 
+FLUSH_GROUP = "session_flushers"
+FLUSH_READ_COUNT = 500
+# Kept short so newly acquired shards are picked up quickly
+FLUSH_BLOCK_MS = 2000
+# Wait after the first event so the human and AI messages of a turn share a flush
+FLUSH_COALESCE_SECONDS = 2
+FLUSH_CONCURRENCY = 4
+# Events a consumer has not acknowledged for this long are retried
+FLUSH_RECLAIM_IDLE_MS = 60_000
+FLUSH_MAINTENANCE_INTERVAL_SECONDS = 60
 
-async def background_flush_task(redis_instance, firestore_db):
+# Key families written before every session key carried an expiry. The leader
+# gives any that are left a TTL once; the marker records that it has run.
+LEGACY_KEY_PATTERNS = (
+    "session:*",
+    "session_count:*",
+    "session_last_activity:*",
+    "session_last_flush:*",
+)
+KEY_LIFECYCLE_MARKER = "key_lifecycle:v1"
+KEY_LIFECYCLE_SCAN_COUNT = 1000
+
+# Records how far a session has been persisted and, once everything up to the
+# last assigned sequence number is in Firestore, drops it from active_sessions.
+# Runs atomically so an append racing with the flush keeps the session active.
+# The cached history itself stays in Redis until its TTL runs out.
+RELEASE_FLUSHED_SCRIPT = """
+local flushed = tonumber(redis.call('HGET', KEYS[1], 'flushed_seq') or '0')
+if tonumber(ARGV[1]) > flushed then
+    flushed = tonumber(ARGV[1])
+    redis.call('HSET', KEYS[1], 'flushed_seq', flushed)
+end
+redis.call('SET', KEYS[2], ARGV[2], 'EX', ARGV[4])
+local seq = tonumber(redis.call('HGET', KEYS[1], 'seq') or '0')
+if flushed >= seq then
+    redis.call('SREM', KEYS[3], ARGV[3])
+end
+"""
+
+
+async def release_flushed(redis_instance, chat_session_id, flushed_seq, flush_time):
+    await redis_instance.eval(
+        RELEASE_FLUSHED_SCRIPT,
+        3,
+        META_KEY.format(chat_session_id),
+        LAST_FLUSH_KEY.format(chat_session_id),
+        "active_sessions",
+        flushed_seq,
+        flush_time,
+        chat_session_id,
+        SESSION_CACHE_TTL_SECONDS,
+    )
+
+
+async def migrate_session_document(firestore_dal, chat_session_id):
+    session_dict = await firestore_dal.get_session(chat_session_id)
+    if session_dict and "chat_history" in session_dict:
+        await firestore_dal.migrate_session_messages(chat_session_id, session_dict)
+
+
+async def ensure_flush_group(redis_instance, shard):
+    try:
+        await redis_instance.xgroup_create(
+            DIRTY_STREAM_KEY.format(shard), FLUSH_GROUP, id="0", mkstream=True
+        )
+    except ResponseError as e:
+        if "BUSYGROUP" not in str(e):
+            raise
+
+
+def _entries(stream_key, messages):
+    return [(stream_key, entry_id, fields["sid"]) for entry_id, fields in messages if fields]
+
+
+async def read_dirty_sessions(redis_instance, consumer, shards):
+    """
+    Blocks until sessions in the given shards are marked dirty, then waits a
+    short coalescing window so both messages of a turn are flushed together.
+    Returns (stream_key, entry_id, session_id) tuples.
+    """
+    streams = {DIRTY_STREAM_KEY.format(shard): ">" for shard in shards}
+    response = await redis_instance.xreadgroup(
+        FLUSH_GROUP, consumer, streams, count=FLUSH_READ_COUNT, block=FLUSH_BLOCK_MS
+    )
+    if not response:
+        return []
+
+    await asyncio.sleep(FLUSH_COALESCE_SECONDS)
+    response += await redis_instance.xreadgroup(
+        FLUSH_GROUP, consumer, streams, count=FLUSH_READ_COUNT
+    ) or []
+    return [
+        entry
+        for stream_key, messages in response
+        for entry in _entries(stream_key, messages)
+    ]
+
+
+async def reclaim_stale_entries(redis_instance, consumer, shard, min_idle_ms):
+    """Takes over events of a shard left unacknowledged by failed flushes or previous owners."""
+    stream_key = DIRTY_STREAM_KEY.format(shard)
+    result = await redis_instance.xautoclaim(
+        stream_key,
+        FLUSH_GROUP,
+        consumer,
+        min_idle_time=min_idle_ms,
+        start_id="0-0",
+        count=FLUSH_READ_COUNT,
+    )
+    return _entries(stream_key, result[1])
+
+
+async def reconcile_active_sessions(redis_instance):
+    """Re-queues sessions that still have unflushed messages, in case an event was trimmed."""
+    active_sessions = await redis_instance.smembers("active_sessions")
+    if not active_sessions:
+        return
+    async with redis_instance.pipeline(transaction=False) as pipe:
+        for chat_session_id in active_sessions:
+            pipe.xadd(
+                dirty_stream_key(chat_session_id),
+                {"sid": chat_session_id},
+                maxlen=DIRTY_STREAM_MAXLEN,
+                approximate=True,
+            )
+        await pipe.execute()
+
+
+async def plan_session_flush(session_manager, chat_session_id):
+    """
+    Returns the Firestore writes that persist a session's unflushed messages
+    and the sequence number they reach, or (None, flushed_seq) if there is
+    nothing to write.
+    """
+    firestore_dal = session_manager.dal
+    binary_redis = session_manager.binary_redis
+    meta_key = META_KEY.format(chat_session_id)
+    messages_key = MESSAGES_KEY.format(chat_session_id)
+
+    # Sessions queued before the history cache existed are warmed first
+    if not await binary_redis.hget(meta_key, "warm"):
+        await session_manager.ensure_cached(chat_session_id)
+
+    meta = {
+        k.decode(): v.decode()
+        for k, v in (await binary_redis.hgetall(meta_key)).items()
+    }
+    if "base_seq" not in meta:
+        # Cached before messages moved to the subcollection: the
+        # cache holds the full history, and the Firestore array
+        # must be migrated before new messages are written
+        await migrate_session_document(firestore_dal, chat_session_id)
+        await binary_redis.hsetnx(meta_key, "base_seq", 0)
+        meta.setdefault("base_seq", "0")
+
+    flushed_seq = int(meta.get("flushed_seq") or 0)
+    if int(meta.get("seq") or 0) <= flushed_seq:
+        return None, flushed_seq
+
+    # List index i holds sequence number base_seq+i+1, so the
+    # unflushed tail starts at index flushed_seq-base_seq
+    base_seq = int(meta.get("base_seq") or 0)
+    new_messages = [
+        unpack_message(r)
+        for r in await binary_redis.lrange(messages_key, flushed_seq - base_seq, -1)
+    ]
+    if not new_messages:
+        return None, flushed_seq
+
+    # ✅ Store latest_pdfId instead of pdfId
+    latest_pdf_id = meta.get("pdfId", "")
+    # The owner is only set when the session document is created
+    session_update = {
+        "chat_session_id": chat_session_id,
+        "message_count": new_messages[-1]["seq"],
+        "last_activity": firestore.SERVER_TIMESTAMP,
+    }
+    if latest_pdf_id:
+        session_update["latest_pdfId"] = latest_pdf_id  # ✅ Store latest PDF used
+
+    # Each message is its own document keyed by sequence number, so a
+    # retried flush rewrites the same documents. The session document
+    # only carries summary fields and is merged, since it is created
+    # off the request path and may not exist yet.
+    writes = [
+        (firestore_dal.message_ref(chat_session_id, msg["seq"]), msg)
+        for msg in new_messages
+    ]
+    writes.append((firestore_dal.session_ref(chat_session_id), session_update))
+    return writes, new_messages[-1]["seq"]
+
+
+def pack_batches(plans):
+    """
+    Groups the writes of many sessions into batches of at most
+    FIRESTORE_MAX_BATCH_WRITES, keeping a session's writes together unless
+    they alone exceed the limit. Returns [(writes, session_ids)].
+    """
+    batches = []
+    writes, session_ids = [], set()
+    for chat_session_id, session_writes in plans:
+        if writes and len(writes) + len(session_writes) > FIRESTORE_MAX_BATCH_WRITES:
+            batches.append((writes, session_ids))
+            writes, session_ids = [], set()
+        for start in range(0, len(session_writes), FIRESTORE_MAX_BATCH_WRITES):
+            chunk = session_writes[start : start + FIRESTORE_MAX_BATCH_WRITES]
+            if writes and len(writes) + len(chunk) > FIRESTORE_MAX_BATCH_WRITES:
+                batches.append((writes, session_ids))
+                writes, session_ids = [], set()
+            writes.extend(chunk)
+            session_ids.add(chat_session_id)
+    if writes:
+        batches.append((writes, session_ids))
+    return batches
+
+
+async def flush_sessions(redis_instance, session_manager, entries):
+    """
+    Persists every session named in `entries`, committing the grouped batches
+    with bounded concurrency. Redis state is released and events acknowledged
+    only for sessions whose batches all committed; the rest stay pending and
+    are retried once reclaimed.
+    """
+    firestore_dal = session_manager.dal
+    entry_ids = defaultdict(list)
+    for stream_key, entry_id, chat_session_id in entries:
+        entry_ids[chat_session_id].append((stream_key, entry_id))
+
+    flush_time = int(time.time())
+    planned = await asyncio.gather(
+        *(
+            plan_session_flush(session_manager, chat_session_id)
+            for chat_session_id in entry_ids
+        ),
+        return_exceptions=True,
+    )
+
+    plans, flushed_seqs, failed = [], {}, set()
+    for chat_session_id, result in zip(entry_ids, planned):
+        if isinstance(result, Exception):
+            logging.error(f"❌ Failed to prepare flush of {chat_session_id}: {result}")
+            failed.add(chat_session_id)
+            continue
+        writes, flushed_seqs[chat_session_id] = result
+        if writes:
+            plans.append((chat_session_id, writes))
+
+    semaphore = asyncio.Semaphore(FLUSH_CONCURRENCY)
+
+    async def commit(writes):
+        async with semaphore:
+            batch = firestore_dal.batch()
+            for ref, data in writes:
+                batch.set(ref, data, merge=True)
+            await firestore_dal.commit(batch)
+
+    batches = pack_batches(plans)
+    results = await asyncio.gather(
+        *(commit(writes) for writes, _ in batches), return_exceptions=True
+    )
+    for (_, session_ids), result in zip(batches, results):
+        if isinstance(result, Exception):
+            logging.error(f"❌ Firestore batch commit failed for {session_ids}: {result}")
+            failed |= session_ids
+
+    done = [sid for sid in entry_ids if sid not in failed]
+    for chat_session_id in done:
+        await release_flushed(
+            redis_instance, chat_session_id, flushed_seqs[chat_session_id], flush_time
+        )
+    acked = defaultdict(list)
+    for chat_session_id in done:
+        for stream_key, entry_id in entry_ids[chat_session_id]:
+            acked[stream_key].append(entry_id)
+    if acked:
+        async with redis_instance.pipeline(transaction=False) as pipe:
+            for stream_key, ids in acked.items():
+                pipe.xack(stream_key, FLUSH_GROUP, *ids)
+                pipe.xdel(stream_key, *ids)
+            await pipe.execute()
+
+    logging.info(
+        f"✅ Flushed {len(plans)} sessions in {len(batches)} batches "
+        f"({len(failed)} failed, {len(entries)} events)"
+    )
+
+
+async def background_flush_task(redis_instance, session_manager, coordinator):
+    """
+    Event-driven flusher: consumes the dirty-session streams of the shards this
+    replica holds leases on and persists changed sessions to Firestore, so work
+    scales with the number of changes and is split across replicas.
+    """
     logging.info("Starting background flush task...")
+    consumer = coordinator.worker_id
+    ready_shards = set()
+    last_maintenance = 0.0
+
     while True:
         try:
             if redis_instance is None or not await redis_instance.ping():
@@ -16,181 +327,101 @@ async def background_flush_task(redis_instance, firestore_db):
                 await asyncio.sleep(10)
                 continue
 
-            active_sessions = await redis_instance.smembers("active_sessions")
-            current_time = int(time.time())
-
-            if not active_sessions:
-                await asyncio.sleep(20)
-                continue  # Skip if no active sessions
-
-            batch = firestore_db.batch()  # Use batch writes for efficiency
-
-            for chat_session_id in active_sessions:
-                keys = [
-                    f"session_count:{chat_session_id}",
-                    f"session_last_activity:{chat_session_id}",
-                    f"session_last_flush:{chat_session_id}",
-                    f"session:{chat_session_id}",
-                ]
-                count_key, timestamp_key, last_flush_key, session_key = keys
-
-                # Fetch all values in one call
-                count_value, last_msg_timestamp, last_flush_time, session_data = (
-                    await redis_instance.mget(*keys)
-                )
-
-                session_data = json.loads(session_data) if session_data else {}
-                msg_count = len(
-                    session_data.get("chat_history", [])
-                )  # Calculate message count from session data
-                last_msg_timestamp = int(last_msg_timestamp or 0)
-                last_flush_time = int(last_flush_time or 0)
+            shards = set(coordinator.shards)
+            if not shards:
+                await asyncio.sleep(FLUSH_COALESCE_SECONDS)
+                continue
 
-                session_ref = firestore_db.collection("sessions").document(
-                    chat_session_id
-                )
-                session_doc = session_ref.get()
+            entries = []
+            for shard in shards - ready_shards:
+                await ensure_flush_group(redis_instance, shard)
+                ready_shards.add(shard)
 
-                # Get chat history from Firestore
-                existing_chat_history = (
-                    session_doc.to_dict().get("chat_history", [])
-                    if session_doc.exists
-                    else []
+            # Events the previous owner of a newly acquired shard never
+            # acknowledged are claimed once its lease must have lapsed
+            for shard in coordinator.new_shards & shards:
+                entries += await reclaim_stale_entries(
+                    redis_instance, consumer, shard, LEASE_TTL_SECONDS * 1000
                 )
+            coordinator.new_shards -= shards
 
-                # Get chat history from Redis
-                redis_chat_history = session_data.get(
-                    "chat_history", []
-                )  # Assuming session_data is from Redis
-                redis_msg_count = len(redis_chat_history)
+            if time.time() - last_maintenance >= FLUSH_MAINTENANCE_INTERVAL_SECONDS:
+                last_maintenance = time.time()
+                if coordinator.is_leader:
+                    await reconcile_active_sessions(redis_instance)
+                for shard in shards:
+                    entries += await reclaim_stale_entries(
+                        redis_instance, consumer, shard, FLUSH_RECLAIM_IDLE_MS
+                    )
 
-                # A session is new if Firestore chat_history is empty AND Redis chat_history has exactly 2 messages
-                is_new_session = (
-                    len(existing_chat_history) == 0 and redis_msg_count == 2
-                )
-
-                should_flush = (
-                    is_new_session  # NEW sessions should flush immediately
-                    or (msg_count >= 4)  # Flush when there are 4 or more messages
-                    or (
-                        (current_time - last_msg_timestamp) >= 60 and msg_count > 0
-                    )  # Flush after 1 minute of inactivity
-                )
+            entries += await read_dirty_sessions(redis_instance, consumer, shards)
+            if not entries:
+                continue
 
-                if not should_flush:
-                    continue  # Skip flushing if conditions are not met
-
-                if session_data:
-                    try:
-                        existing_chat_history = (
-                            session_doc.to_dict().get("chat_history", [])
-                            if session_doc.exists
-                            else []
-                        )
-                        last_saved_timestamp = (
-                            existing_chat_history[-1]["timestamp"]
-                            if existing_chat_history
-                            else 0
-                        )
-
-                        new_messages = [
-                            msg
-                            for msg in session_data.get("chat_history", [])
-                            if msg["timestamp"] > last_saved_timestamp
-                        ]
-
-                        # ✅ Store latest_pdfId instead of pdfId
-                        latest_pdf_id = session_data.get("pdfId", "")
-                        stored_pdf_id = (
-                            session_doc.to_dict().get("latest_pdfId", "")
-                            if session_doc.exists
-                            else None
-                        )
-
-                        if is_new_session:
-                            batch.update(
-                                session_ref,
-                                {
-                                    "userId": session_data.get("userId", ""),
-                                    "latest_pdfId": latest_pdf_id,  # ✅ Store latest PDF used
-                                    "chat_session_id": chat_session_id,
-                                    "chat_history": session_data.get(
-                                        "chat_history", []
-                                    ),
-                                    "last_activity": firestore.SERVER_TIMESTAMP,
-                                },
-                            )
-                            logging.info(
-                                f"✅ Created new session {chat_session_id} in Firestore."
-                            )
-                        else:
-                            logging.info(
-                                f"✅ Updating existing session {chat_session_id} in Firestore."
-                            )
-                            batch.update(
-                                session_ref,
-                                {
-                                    "chat_history": firestore.ArrayUnion(new_messages),
-                                    "last_activity": firestore.SERVER_TIMESTAMP,
-                                },
-                            )
-
-                        # ✅ Update latest_pdfId in Firestore only if it changed
-                        if latest_pdf_id and latest_pdf_id != stored_pdf_id:
-                            batch.update(session_ref, {"latest_pdfId": latest_pdf_id})
-
-                        # Use Redis pipeline for batch operations
-                        async with redis_instance.pipeline() as pipe:
-                            pipe.delete(count_key, timestamp_key, session_key)
-                            pipe.srem("active_sessions", chat_session_id)
-                            pipe.set(last_flush_key, current_time)
-                            await pipe.execute()
-
-                        batch.commit()
-                        logging.info(
-                            f"✅ Flushed session {chat_session_id} to Firestore with latest_pdfId {latest_pdf_id}."
-                        )
-
-                    except json.JSONDecodeError:
-                        logging.error(
-                            f"❌ Failed to decode session {chat_session_id}, skipping."
-                        )
-
-            logging.info(
-                f"✅ Completed session flush check. Current active sessions: {len(active_sessions)}"
-            )
+            cycle_start = time.perf_counter()
+            await flush_sessions(redis_instance, session_manager, entries)
+            observe("flush_cycle", time.perf_counter() - cycle_start)
 
         except Exception as e:
             logging.error(f"❌ Error in background_flush_task: {e}")
+            await asyncio.sleep(5)
+
 
-        await asyncio.sleep(30)
+async def expire_keys_without_ttl(redis_instance, keys):
+    """Gives the keys that have no expiry yet the session TTL, in two pipelined round trips."""
+    async with redis_instance.pipeline(transaction=False) as pipe:
+        for key in keys:
+            pipe.ttl(key)
+        ttls = await pipe.execute()
 
+    # TTL is -1 for keys without an expiry (-2 once they are gone)
+    persistent = [key for key, ttl in zip(keys, ttls) if ttl == -1]
+    if persistent:
+        async with redis_instance.pipeline(transaction=False) as pipe:
+            for key in persistent:
+                pipe.expire(key, SESSION_CACHE_TTL_SECONDS)
+            await pipe.execute()
+    return len(persistent)
 
-async def cleanup_stale_flush_keys(redis_instance):
+
+async def apply_key_lifecycle(redis_instance, coordinator):
+    """
+    One-off reconciliation for keys written before the TTL lifecycle: the
+    leader scans the legacy key families once and sets expirations in bulk.
+    New keys get their expiry on write, so nothing needs sweeping afterwards.
+    """
     while True:
         try:
             if redis_instance is None or not await redis_instance.ping():
-                logging.error("❌ Redis instance is unavailable, skipping cleanup.")
+                logging.error("❌ Redis instance is unavailable, skipping key lifecycle.")
                 await asyncio.sleep(60)
                 continue
 
-            current_time = int(time.time())
-            stale_threshold = current_time - 86400  # 24 hours ago
+            if await redis_instance.exists(KEY_LIFECYCLE_MARKER):
+                return
 
-            # Scan for all session_last_flush keys
-            cursor = "0"
-            while cursor != 0:
-                cursor, keys = await redis_instance.scan(
-                    cursor, match="session_last_flush:*", count=100
-                )
-                for key in keys:
-                    last_flush_time = int(await redis_instance.get(key) or 0)
-                    if last_flush_time < stale_threshold:
-                        await redis_instance.delete(key)
-                        logging.info(f"✅ Deleted stale key: {key}")
+            # Cluster-wide pass: only the leader replica runs it
+            if not coordinator.is_leader:
+                await asyncio.sleep(60)
+                continue
+
+            expired = 0
+            for pattern in LEGACY_KEY_PATTERNS:
+                keys = []
+                async for key in redis_instance.scan_iter(
+                    match=pattern, count=KEY_LIFECYCLE_SCAN_COUNT
+                ):
+                    keys.append(key)
+                    if len(keys) >= KEY_LIFECYCLE_SCAN_COUNT:
+                        expired += await expire_keys_without_ttl(redis_instance, keys)
+                        keys = []
+                if keys:
+                    expired += await expire_keys_without_ttl(redis_instance, keys)
 
-            await asyncio.sleep(21600)  # Run cleanup every 6 hours
+            await redis_instance.set(KEY_LIFECYCLE_MARKER, int(time.time()))
+            logging.info(f"✅ Set expiry on {expired} legacy session keys")
+            return
 
         except Exception as e:
-            logging.error(f"❌ Error in cleanup_stale_flush_keys: {e}")
+            logging.error(f"❌ Error in apply_key_lifecycle: {e}")
             await asyncio.sleep(60)
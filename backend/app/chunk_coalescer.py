@@ -0,0 +1,94 @@
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, List, Optional
+
+# The first chunk of an answer is published immediately. After that, chunks
+# are buffered until COALESCE_MAX_BYTES have accumulated or the flush window
+# has passed, whichever comes first; a timer flushes the tail so a chunk never
+# waits for the next one. The window starts at COALESCE_MIN_DELAY and doubles
+# (up to COALESCE_MAX_DELAY) while publishes are slow, i.e. while Redis or the
+# subscribers lag, and halves again once they keep up.
+COALESCE_MIN_DELAY = 0.03
+COALESCE_MAX_DELAY = 0.25
+COALESCE_MAX_BYTES = 512
+COALESCE_SLOW_PUBLISH = 0.05
+
+
+class ChunkCoalescer:
+    """
+    Batches streamed text chunks into as few publishes as latency allows.
+    Only one publish is in flight at a time; chunks arriving meanwhile are
+    buffered and go out together with the next one.
+    """
+
+    def __init__(
+        self,
+        publish: Callable[[str], Awaitable[None]],
+        min_delay: float = COALESCE_MIN_DELAY,
+        max_delay: float = COALESCE_MAX_DELAY,
+        max_bytes: int = COALESCE_MAX_BYTES,
+        slow_publish: float = COALESCE_SLOW_PUBLISH,
+    ):
+        self.publish = publish
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.max_bytes = max_bytes
+        self.slow_publish = slow_publish
+        self.delay = min_delay
+        self.buffer: List[str] = []
+        self.buffered_bytes = 0
+        self.first_sent = False
+        self.timer: Optional[asyncio.Task] = None
+        self.lock = asyncio.Lock()
+
+    async def add(self, chunk: str):
+        self.buffer.append(chunk)
+        self.buffered_bytes += len(chunk.encode())
+
+        if not self.first_sent or (
+            self.buffered_bytes >= self.max_bytes and not self.lock.locked()
+        ):
+            await self.flush()
+        elif self.timer is None:
+            self.timer = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.delay)
+        self.timer = None
+        try:
+            await self.flush()
+        except Exception as e:
+            logging.error(f"❌ Failed publishing buffered chunks: {e}")
+
+    async def flush(self):
+        async with self.lock:
+            if not self.buffer:
+                return
+            # A pending timer is still sleeping (it clears itself before flushing)
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            text = "".join(self.buffer)
+            self.buffer = []
+            self.buffered_bytes = 0
+
+            start = time.perf_counter()
+            await self.publish(text)
+            self.first_sent = True
+            if time.perf_counter() - start > self.slow_publish:
+                self.delay = min(self.delay * 2, self.max_delay)
+            else:
+                self.delay = max(self.delay / 2, self.min_delay)
+
+    async def close(self):
+        """Publish whatever is still buffered."""
+        await self.flush()
+
+    def cancel(self):
+        """Drop the buffer and any pending tail flush, e.g. when the stream failed."""
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        self.buffer = []
+        self.buffered_bytes = 0
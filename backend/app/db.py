@@ -2,9 +2,13 @@ import redis.asyncio as redis
 from dotenv import load_dotenv
 from .session_manager_firebase import SessionManager
 from contextlib import asynccontextmanager
-from .bg_worker import background_flush_task, cleanup_stale_flush_keys
+from .bg_worker import background_flush_task, apply_key_lifecycle
 from .bg_pdf_worker import process_pdf_worker
 from .demo_routes import start_cleanup_task
+from .firestore_dal import FirestoreDAL
+from .flush_coordinator import FlushCoordinator
+from .pubsub_multiplexer import PubSubMultiplexer
+from .token_budget import load_encoding
 import os
 import logging
 import asyncio
@@ -22,7 +26,7 @@ REDIS_PASSWORD = os.getenv("REDIS_PASSWORD")
 FIREBASE_CREDENTIALS_BASE64 = os.getenv("FIREBASE_CREDENTIALS_BASE64")
 
 
-async def init_redis():
+async def init_redis(decode_responses: bool = True):
     """Initialize Redis connection asynchronously."""
     try:
         # Extract host and port from REDIS_URL (redis://host:port)
@@ -33,7 +37,7 @@ async def init_redis():
             host=host,
             port=int(port),
             password=REDIS_PASSWORD,
-            decode_responses=True,
+            decode_responses=decode_responses,
             ssl=False,  # Explicitly disable SSL
         )
         logging.info("✅ Connected to Redis")
@@ -60,6 +64,8 @@ try:
     # Global Firestore and Storage Clients
     firestore_db = firestore.client()
     firebase_storage = storage.bucket()
+    # All Firestore access goes through the DAL so it never blocks the event loop
+    firestore_dal = FirestoreDAL(firestore_db)
 
     logging.info("✅ Firestore and Firebase Storage initialized.")
 
@@ -67,6 +73,7 @@ except Exception as e:
     logging.error(f"❌ Failed to initialize Firebase: {e}")
     firestore_db = None
     firebase_storage = None
+    firestore_dal = None
 
 
 @asynccontextmanager
@@ -74,18 +81,40 @@ async def lifespan(app):
     """Manage application startup and shutdown lifecycle."""
     # Initialize Redis and store in app state
     app.state.redis_instance = await init_redis()
+    # Session records are binary-encoded, see session_codec
+    app.state.binary_redis = await init_redis(decode_responses=False)
+
+    # The tokenizer may be downloaded, so load it off the event loop, once
+    await asyncio.to_thread(load_encoding)
 
     # Initialize SessionManager with Redis
-    if firestore_db:
+    app.state.firestore_dal = firestore_dal
+    if firestore_dal:
         app.state.session_manager_firebase = SessionManager(
-            firestore_db, app.state.redis_instance
+            firestore_dal, app.state.redis_instance, app.state.binary_redis
         )
     else:
         app.state.session_manager_firebase = None
 
-    # Start background tasks
-    asyncio.create_task(background_flush_task(app.state.redis_instance, firestore_db))
-    asyncio.create_task(cleanup_stale_flush_keys(app.state.redis_instance))
+    # Start background tasks; flush shards and the leader role are leased
+    # across replicas by the coordinator
+    flush_coordinator = FlushCoordinator(app.state.redis_instance)
+    asyncio.create_task(flush_coordinator.run())
+    asyncio.create_task(
+        background_flush_task(
+            app.state.redis_instance,
+            app.state.session_manager_firebase,
+            flush_coordinator,
+        )
+    )
+    asyncio.create_task(
+        apply_key_lifecycle(app.state.redis_instance, flush_coordinator)
+    )
+
+    # One pub/sub connection per process serves every SSE stream
+    app.state.pubsub_multiplexer = PubSubMultiplexer(app.state.redis_instance)
+    if app.state.redis_instance:
+        asyncio.create_task(app.state.pubsub_multiplexer.run())
 
     # Start PDF processing worker
     asyncio.create_task(process_pdf_worker(app.state.redis_instance))
@@ -95,10 +124,19 @@ async def lifespan(app):
     yield  # Keeps the app running
 
     # Cleanup on shutdown
+    await flush_coordinator.stop()
+
     if app.state.redis_instance:
+        await app.state.pubsub_multiplexer.close()
         await app.state.redis_instance.close()
         logging.info("❌ Redis connection closed")
 
+    if app.state.binary_redis:
+        await app.state.binary_redis.close()
+
+    if firestore_dal:
+        firestore_dal.close()
+
     if firebase_admin._apps:
         firebase_admin.delete_app(firebase_admin.get_app())
         logging.info("❌ Firebase connection closed")
@@ -7,12 +7,20 @@ import logging
 import json
 import os
 import time
-from collections import defaultdict
-from typing import Dict, List
+from typing import List
 
 # Assume your local imports work
-from .pinecone_retriever_chain import create_chain
+from .pinecone_retriever_chain import create_chain, sources_from_docs
+from .demo_session_store import (
+    DEMO_MAX_MESSAGE_BYTES,
+    SESSION_CLOSED,
+    DemoSessionStore,
+)
 from .query_refiner import refine_user_query
+from .stream_with_indentation_fix import (
+    extract_chunk_text,
+    stream_with_indentation_fix,
+)
 
 from slowapi import Limiter
 from slowapi.util import get_remote_address
@@ -21,20 +29,17 @@ from pydantic import BaseModel
 from langchain_core.messages import (
     HumanMessage,
     AIMessage,
-    BaseMessage,
 )
 
 # --- Globals for Demo ---
-# Restore the message queue
-message_queues: Dict[str, asyncio.Queue] = defaultdict(asyncio.Queue)
-# History and activity tracking remain
-demo_chat_histories: Dict[str, List[BaseMessage]] = defaultdict(list)
-demo_session_last_activity: Dict[str, float] = {}
-memory_lock = asyncio.Lock()  # Lock for shared memory access
+# Queued messages, histories and activity of the demo sessions, bounded in
+# number and memory
+demo_sessions = DemoSessionStore()
 
 # --- Constants ---
-DEMO_SESSION_TIMEOUT_SECONDS = 5 * 60  # 5 minutes (adjust as needed)
-CLEANUP_INTERVAL_SECONDS = 60  # Check every minute
+DISCONNECT_CHECK_INTERVAL_SECONDS = 0.5  # How often a stream checks for an aborted client
+STREAM_WAIT_FOR_SEND_SECONDS = 10.0  # How long a stream opened before its send waits
+STREAM_WAIT_POLL_SECONDS = 0.25
 
 # --- Router Definition ---
 demo_router = APIRouter()
@@ -48,42 +53,12 @@ class DemoMessageRequest(BaseModel):
     demo_secret: str
 
 
-# --- Background Cleanup Task ---
-async def cleanup_inactive_demo_sessions():
-    """Periodically removes demo sessions inactive for too long."""
-    while True:
-        await asyncio.sleep(CLEANUP_INTERVAL_SECONDS)
-        now = time.time()
-        inactive_sessions = []
-        # Make a copy of keys to avoid runtime error during iteration
-        session_ids = list(demo_session_last_activity.keys())
-
-        async with memory_lock:  # Protect access to shared dictionaries
-            for session_id in session_ids:
-                last_activity = demo_session_last_activity.get(session_id)
-                if last_activity and (
-                    now - last_activity > DEMO_SESSION_TIMEOUT_SECONDS
-                ):
-                    inactive_sessions.append(session_id)
-
-            if inactive_sessions:
-                logging.info(
-                    f"🧹 Cleaning up inactive demo sessions: {inactive_sessions}"
-                )
-                for session_id in inactive_sessions:
-                    # Use pop with default to avoid KeyErrors
-                    demo_chat_histories.pop(session_id, None)
-                    demo_session_last_activity.pop(session_id, None)
-                    # Also remove the message queue for the inactive session
-                    message_queues.pop(session_id, None)
-
-
 # --- Function to run cleanup task (call this from startup) ---
 def start_cleanup_task():
     logging.info(
         "🚀 Starting background task for cleaning up inactive demo sessions..."
     )
-    asyncio.create_task(cleanup_inactive_demo_sessions())
+    asyncio.create_task(demo_sessions.run_expiry())
 
 
 # --- Demo Routes ---
@@ -113,18 +88,27 @@ async def demo_chat_send(request: Request, messageRequest: DemoMessageRequest):
         f"🚀 Received message for demo session {chat_session_id}: '{user_message}'"
     )
 
+    if len(user_message.encode("utf-8")) > DEMO_MAX_MESSAGE_BYTES:
+        raise HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail="Message too long",
+        )
+
     # --- Queue the message ---
-    # No lock needed for defaultdict with Queue creation itself
     # Put the message data into the specific queue for this session
-    # The stream endpoint will await message_queues[chat_session_id].get()
-    await message_queues[chat_session_id].put(
-        {"message": user_message, "pdf_id": pdf_id}
-    )
+    # The stream endpoint will await its session's queue
+    session = demo_sessions.get_or_create(chat_session_id)
+    try:
+        session.queue.put_nowait({"message": user_message, "pdf_id": pdf_id})
+    except asyncio.QueueFull:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Too many queued messages for this session",
+        )
     logging.info(f"Message queued for session {chat_session_id}")
 
     # --- Update Activity Time ---
-    async with memory_lock:
-        demo_session_last_activity[chat_session_id] = time.time()
+    demo_sessions.touch(chat_session_id, session)
 
     return JSONResponse(
         status_code=status.HTTP_200_OK,
@@ -148,16 +132,18 @@ async def demo_chat_stream(request: Request, chat_session_id: str):
         )
 
         # --- Dequeue Message ---
-        if chat_session_id not in message_queues:
+        # Only demo_chat_send, which checks the secret, creates sessions; a
+        # stream opened first waits for it instead of taking a slot
+        session = demo_sessions.get(chat_session_id)
+        if session is None:
             logging.warning(
                 f"No active message queue found for session {chat_session_id}. Did send run?"
             )
-            try:
-                # Add timeout to prevent infinite waiting if send fails
-                message_data = await asyncio.wait_for(
-                    message_queues[chat_session_id].get(), timeout=10.0
-                )
-            except asyncio.TimeoutError:
+            deadline = time.monotonic() + STREAM_WAIT_FOR_SEND_SECONDS
+            while session is None and time.monotonic() < deadline:
+                await asyncio.sleep(STREAM_WAIT_POLL_SECONDS)
+                session = demo_sessions.get(chat_session_id)
+            if session is None:
                 logging.error(
                     f"Timeout waiting for message for session {chat_session_id}"
                 )
@@ -167,19 +153,20 @@ async def demo_chat_stream(request: Request, chat_session_id: str):
                     yield "event: error\ndata: Timeout waiting for message\n\n"
 
                 return StreamingResponse(empty_stream(), media_type="text/event-stream")
-            except KeyError:
-                logging.error(
-                    f"Message queue key error for session {chat_session_id} (likely cleaned up)."
-                )
 
-                async def error_stream():
-                    # Using the same error format as generation errors
-                    yield "event: error\ndata: Session expired or not found\n\n"
+        # Get the message data from the queue for this session (blocks if empty)
+        message_data = await session.queue.get()
+
+        if message_data is SESSION_CLOSED:
+            logging.error(
+                f"Demo session {chat_session_id} expired or was evicted while waiting."
+            )
 
-                return StreamingResponse(error_stream(), media_type="text/event-stream")
-        else:
-            # Get the message data from the queue for this session (blocks if empty)
-            message_data = await message_queues[chat_session_id].get()
+            async def error_stream():
+                # Using the same error format as generation errors
+                yield "event: error\ndata: Session expired or not found\n\n"
+
+            return StreamingResponse(error_stream(), media_type="text/event-stream")
 
         user_message = message_data["message"]
         pdf_id = message_data["pdf_id"]
@@ -195,16 +182,14 @@ async def demo_chat_stream(request: Request, chat_session_id: str):
         )
 
         # Mark the message as processed by the queue
-        message_queues[
-            chat_session_id
-        ].task_done()  # Important for queue management if needed later
+        session.queue.task_done()  # Important for queue management if needed later
 
         # --- Fetch History ---
-        async with memory_lock:
+        async with session.lock:
             # Fetch history *before* adding current message
-            history_before_current = demo_chat_histories[chat_session_id].copy()
+            history_before_current = session.history.copy()
             # Update activity time now that we are processing
-            demo_session_last_activity[chat_session_id] = time.time()
+            demo_sessions.touch(chat_session_id, session)
             # Lock released after this block
 
         # --- Prepare Message Object ---
@@ -226,7 +211,7 @@ async def demo_chat_stream(request: Request, chat_session_id: str):
         current_history_for_chain = history_before_current + [human_msg_object]
 
         # --- Create Main Retrieval Chain ---
-        retrieval_chain = create_chain(
+        retriever, answer_chain = create_chain(
             chat_history=current_history_for_chain,
             user_id="demo-user",  # Hardcoded user_id for demo
             pdf_id=pdf_id,
@@ -235,128 +220,107 @@ async def demo_chat_stream(request: Request, chat_session_id: str):
             mode=retrieval_method,  # Pass retrieval_method from request
         )
 
+        # --- History Update ---
+        async def store_history(ai_response_chunks: List[str], truncated: bool):
+            """Adds the human message and the (possibly partial) AI response to the history."""
+            # Note: The full_ai_response accumulated here uses the *original* chunks.
+            # If you want the history to store the *processed* version, you would need
+            # to accumulate `processed_chunk_for_stream` instead, but this might lose
+            # intentional indentation inside code blocks in the history.
+            # Let's keep accumulating original for history for now, assuming history stores raw AI output.
+            full_ai_response = "".join(ai_response_chunks)
+            async with session.lock:
+                # Add the processed human message and AI response to the session history
+                new_messages = [human_msg_object]
+                if ai_response_chunks:
+                    # Storing original AI output; a cancelled answer is marked truncated
+                    ai_msg = AIMessage(
+                        content=full_ai_response,
+                        response_metadata={"truncated": True} if truncated else {},
+                    )
+                    new_messages.append(ai_msg)
+                    log_msg = f"Stored Human+AI messages for {chat_session_id}."
+                else:
+                    log_msg = f"Stored Human message for {chat_session_id} (No AI response)."
+                    logging.warning(
+                        f"No AI response generated for session {chat_session_id}"
+                    )
+                # Also updates the activity time and enforces the memory caps
+                demo_sessions.append_history(chat_session_id, session, new_messages)
+
+                logging.info(f"{log_msg} History length: {len(session.history)}")
+
         # --- Generate Streaming Response ---
         async def generate():
             """Generator function to stream AI responses and update history."""
             ai_response_chunks = []
-            ai_response_generated = False
-            # State to track if the last character processed was a newline
-            # Used to determine if leading whitespace should be stripped from the next chunk
-            last_char_was_newline = (
-                True  # State: Assume the response starts after a conceptual newline
-            )
+            chain_stream = None
+            last_disconnect_check = time.monotonic()
+            truncated = False
 
             try:
-                # Stream the response using the REFINED query
-                async for chunk in retrieval_chain.astream(refined_query):
-                    content_to_process = None
-                    # Handle different possible chunk structures (adapt as needed)
-                    if isinstance(chunk, dict):
-                        if "answer" in chunk:
-                            content_to_process = chunk["answer"]
-                        elif "content" in chunk:
-                            content_to_process = chunk["content"]
-                        elif (
-                            "text" in chunk
-                        ):  # Added 'text' based on previous observation
-                            content_to_process = chunk["text"]
-                    elif hasattr(chunk, "content"):
-                        content_to_process = chunk.content
-                    # Add a fallback for raw string chunks if they occur unexpectedly
-                    elif isinstance(chunk, str):
-                        content_to_process = chunk
-
-                    if content_to_process is not None and isinstance(
-                        content_to_process, str
-                    ):
-                        ai_response_generated = True
-
-                        processed_chunk_for_stream = content_to_process
-
-                        # --- Streaming Post-processing: Remove leading whitespace from lines ---
-                        # Only strip leading whitespace if the previous character was a newline.
-                        # This targets unintended indentation at the start of lines (like for paragraphs or lists).
-                        # This WILL remove indentation from 'indented code blocks' (4+ spaces) if they start a chunk after a newline.
-                        # It should generally preserve indentation *within* fenced code blocks (```).
-                        if (
-                            last_char_was_newline
-                            and processed_chunk_for_stream.lstrip()
-                            != processed_chunk_for_stream
-                        ):
-                            # If the last char was a newline AND the chunk starts with whitespace, strip it.
-                            processed_chunk_for_stream = (
-                                processed_chunk_for_stream.lstrip()
-                            )
-                        # --- End Streaming Post-processing ---
-
-                        # Append the original chunk to the list for accumulating the full response (for history)
-                        ai_response_chunks.append(content_to_process)
-
-                        # Create the SSE payload with the potentially processed chunk
-                        sse_payload = {
-                            "type": "chunk",
-                            "content": processed_chunk_for_stream,
-                        }
-                        # Ensure the payload is a valid JSON string
-                        try:
-                            yield f"data: {json.dumps(sse_payload)}\n\n"
-                        except Exception as json_e:
-                            logging.error(
-                                f"Failed to JSON encode payload: {sse_payload}. Error: {json_e}"
-                            )
-                            # Optionally yield an error event here if JSON encoding fails
-                            yield f"event: error\ndata: Failed to encode response chunk.\n\n"
-                            # Decide if you want to stop the stream here or try to continue
-
-                        # Update the state for the next chunk based on the *original* chunk
-                        if content_to_process:  # Only update if the chunk had content
-                            if content_to_process.endswith("\n"):
-                                last_char_was_newline = True
-                            else:
-                                # If the chunk contains newlines within it, check the very last character
-                                last_char_was_newline = content_to_process.endswith(
-                                    "\n"
-                                )
-                        # If content_to_process was None or empty string, the state doesn't change
-
-                # If content_to_process was None or not a string, the loop continues,
-                # but we should ensure last_char_was_newline is handled.
-                # If a chunk is not text (e.g., tool calls), we might need to handle state update based on its effect,
-                # but assuming the chain only yields text chunks for the final answer stream.
-
-                # Send end event
-                yield "event: end\ndata: \n\n"  # Empty data field for end event
+                # Send the citations as soon as retrieval is done, before the
+                # first token
+                docs = await retriever.ainvoke(refined_query)
+                sources_payload = {"type": "sources", "sources": sources_from_docs(docs)}
+                yield f"data: {json.dumps(sources_payload)}\n\n"
+
+                chain_stream = answer_chain.astream(
+                    {"docs": docs, "question": refined_query}
+                )
+                # Stream the response using the REFINED query; the shared
+                # post-processor strips line indentation outside code fences
+                async for chunk, processed_chunk_for_stream in stream_with_indentation_fix(
+                    chain_stream
+                ):
+                    content_to_process = extract_chunk_text(chunk)
+                    if content_to_process is None:
+                        continue
 
-                # --- History Update ---
-                # Note: The full_ai_response accumulated here uses the *original* chunks.
-                # If you want the history to store the *processed* version, you would need
-                # to accumulate `processed_chunk_for_stream` instead, but this might lose
-                # intentional indentation inside code blocks in the history.
-                # Let's keep accumulating original for history for now, assuming history stores raw AI output.
-                full_ai_response = "".join(ai_response_chunks)
-                async with memory_lock:
-                    # Add the processed human message and AI response to shared history
-                    demo_chat_histories[chat_session_id].append(human_msg_object)
-                    if ai_response_generated:
-                        # If you want history to store processed, process full_ai_response here
-                        # processed_full_response = process_full_text_markdown_indentation(full_ai_response) # Requires a new function
-                        ai_msg = AIMessage(
-                            content=full_ai_response
-                        )  # Storing original AI output
-                        demo_chat_histories[chat_session_id].append(ai_msg)
-                        log_msg = f"Stored Human+AI messages for {chat_session_id}."
-                    else:
-                        log_msg = f"Stored Human message for {chat_session_id} (No AI response)."
-                        logging.warning(
-                            f"No AI response generated for session {chat_session_id}"
+                    # Append the original chunk to the list for accumulating the full response (for history)
+                    ai_response_chunks.append(content_to_process)
+
+                    # Stop generating once the client is gone
+                    if (
+                        time.monotonic() - last_disconnect_check
+                        >= DISCONNECT_CHECK_INTERVAL_SECONDS
+                    ):
+                        last_disconnect_check = time.monotonic()
+                        if await request.is_disconnected():
+                            truncated = True
+                            break
+
+                    # Create the SSE payload with the processed chunk
+                    sse_payload = {
+                        "type": "chunk",
+                        "content": processed_chunk_for_stream,
+                    }
+                    # Ensure the payload is a valid JSON string
+                    try:
+                        yield f"data: {json.dumps(sse_payload)}\n\n"
+                    except Exception as json_e:
+                        logging.error(
+                            f"Failed to JSON encode payload: {sse_payload}. Error: {json_e}"
                         )
+                        # Optionally yield an error event here if JSON encoding fails
+                        yield f"event: error\ndata: Failed to encode response chunk.\n\n"
+                        # Decide if you want to stop the stream here or try to continue
 
+                if truncated:
                     logging.info(
-                        f"{log_msg} History length: {len(demo_chat_histories[chat_session_id])}"
+                        f"✂️ Demo client for {chat_session_id} disconnected, generation cancelled"
                     )
-                    # Update activity time *after* successful processing
-                    demo_session_last_activity[chat_session_id] = time.time()
+                else:
+                    # Send end event
+                    yield "event: end\ndata: \n\n"  # Empty data field for end event
+
+                # --- History Update ---
+                await store_history(ai_response_chunks, truncated)
 
+            except asyncio.CancelledError:
+                # The server cancels the response when the client aborts
+                await store_history(ai_response_chunks, truncated=True)
+                raise
             except Exception as e:
                 logging.exception(
                     f"❌ Error generating stream for session {chat_session_id}: {e}"
@@ -364,6 +328,10 @@ async def demo_chat_stream(request: Request, chat_session_id: str):
                 error_message = f"Error processing message: {str(e)}".replace("\n", " ")
                 # Error format already matches
                 yield f"event: error\ndata: {error_message}\n\n"
+            finally:
+                # Closes the underlying LLM request if generation was cut short
+                if chain_stream is not None:
+                    await chain_stream.aclose()
 
         return StreamingResponse(generate(), media_type="text/event-stream")
 
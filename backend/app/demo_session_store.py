@@ -0,0 +1,155 @@
+import asyncio
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import List, Optional
+
+from langchain_core.messages import BaseMessage
+
+# --- Limits ---
+DEMO_SESSION_TIMEOUT_SECONDS = 5 * 60  # 5 minutes (adjust as needed)
+CLEANUP_INTERVAL_SECONDS = 60  # Upper bound between expiry runs
+DEMO_MAX_SESSIONS = int(os.getenv("DEMO_MAX_SESSIONS", 1000))
+# Total size of the message text held in all demo histories
+DEMO_MAX_HISTORY_BYTES = int(os.getenv("DEMO_MAX_HISTORY_BYTES", 64 * 1024 * 1024))
+# A single session drops its oldest messages beyond this size
+DEMO_MAX_SESSION_HISTORY_BYTES = 256 * 1024
+DEMO_MAX_MESSAGE_BYTES = 8 * 1024
+DEMO_QUEUE_SIZE = 8
+
+# Put on the queue of a session that expired or was evicted, so a stream
+# waiting on it stops instead of waiting on a queue nobody sends to
+SESSION_CLOSED = object()
+
+
+def message_size(message: BaseMessage) -> int:
+    content = message.content
+    if isinstance(content, str):
+        return len(content.encode("utf-8"))
+    return len(str(content))
+
+
+class DemoSession:
+    """The queued messages, history and lock of one demo session."""
+
+    def __init__(self):
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=DEMO_QUEUE_SIZE)
+        self.history: List[BaseMessage] = []
+        self.history_bytes = 0
+        # Serializes history reads and writes of this session only
+        self.lock = asyncio.Lock()
+        self.last_activity = time.monotonic()
+
+
+class DemoSessionStore:
+    """
+    In-memory demo sessions, capped in number and in the total size of their
+    histories. Sessions are kept in order of last activity, so expiry and
+    eviction both take the least recently active session from the front
+    without looking at the others.
+    """
+
+    def __init__(
+        self,
+        max_sessions: int = DEMO_MAX_SESSIONS,
+        max_history_bytes: int = DEMO_MAX_HISTORY_BYTES,
+        max_session_history_bytes: int = DEMO_MAX_SESSION_HISTORY_BYTES,
+        timeout_seconds: float = DEMO_SESSION_TIMEOUT_SECONDS,
+    ):
+        self.max_sessions = max_sessions
+        self.max_history_bytes = max_history_bytes
+        self.max_session_history_bytes = max_session_history_bytes
+        self.timeout_seconds = timeout_seconds
+        self.sessions: "OrderedDict[str, DemoSession]" = OrderedDict()
+        self.history_bytes = 0
+
+    def get(self, chat_session_id: str) -> Optional[DemoSession]:
+        self.expire()
+        return self.sessions.get(chat_session_id)
+
+    def get_or_create(self, chat_session_id: str) -> DemoSession:
+        session = self.get(chat_session_id)
+        if session is None:
+            while len(self.sessions) >= self.max_sessions:
+                self.evict_oldest("session limit reached")
+            session = self.sessions[chat_session_id] = DemoSession()
+        return session
+
+    def touch(self, chat_session_id: str, session: DemoSession):
+        """Record activity on a session, moving it to the back of the expiry order."""
+        if self.sessions.get(chat_session_id) is session:
+            session.last_activity = time.monotonic()
+            self.sessions.move_to_end(chat_session_id)
+
+    def append_history(
+        self, chat_session_id: str, session: DemoSession, messages: List[BaseMessage]
+    ):
+        """
+        Adds messages to a session's history; call with the session's lock held.
+        The session's oldest messages are dropped beyond its share, and the
+        least recently active sessions are evicted beyond the total cap.
+        """
+        before = session.history_bytes
+        session.history.extend(messages)
+        session.history_bytes += sum(message_size(m) for m in messages)
+
+        drop = 0
+        while (
+            session.history_bytes > self.max_session_history_bytes
+            and drop < len(session.history) - len(messages)
+        ):
+            session.history_bytes -= message_size(session.history[drop])
+            drop += 1
+        del session.history[:drop]
+
+        # A session evicted while it was generating no longer counts
+        if self.sessions.get(chat_session_id) is not session:
+            return
+        self.touch(chat_session_id, session)
+        self.history_bytes += session.history_bytes - before
+        while self.history_bytes > self.max_history_bytes and len(self.sessions) > 1:
+            self.evict_oldest("history memory limit reached")
+
+    def drop(self, chat_session_id: str):
+        session = self.sessions.pop(chat_session_id, None)
+        if session is None:
+            return
+        self.history_bytes -= session.history_bytes
+        try:
+            session.queue.put_nowait(SESSION_CLOSED)
+        except asyncio.QueueFull:
+            # Messages are still queued, so no stream is waiting on it
+            pass
+
+    def evict_oldest(self, reason: str):
+        chat_session_id = next(iter(self.sessions))
+        logging.warning(f"⚠️ Evicting demo session {chat_session_id}: {reason}")
+        self.drop(chat_session_id)
+
+    def expire(self) -> List[str]:
+        """Removes the sessions inactive for longer than the timeout."""
+        now = time.monotonic()
+        expired = []
+        while self.sessions:
+            chat_session_id, session = next(iter(self.sessions.items()))
+            if now - session.last_activity <= self.timeout_seconds:
+                break
+            self.drop(chat_session_id)
+            expired.append(chat_session_id)
+        if expired:
+            logging.info(f"🧹 Cleaning up inactive demo sessions: {expired}")
+        return expired
+
+    async def run_expiry(self):
+        """Expires sessions as the oldest one times out, checking at least every minute."""
+        while True:
+            self.expire()
+            delay = CLEANUP_INTERVAL_SECONDS
+            if self.sessions:
+                oldest = next(iter(self.sessions.values()))
+                expires_in = (
+                    oldest.last_activity + self.timeout_seconds - time.monotonic()
+                )
+                delay = min(delay, max(expires_in, 1))
+            await asyncio.sleep(delay)
@@ -0,0 +1,179 @@
+import asyncio
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import List, Optional
+
+from google.cloud import firestore
+
+FIRESTORE_MAX_WORKERS = int(os.getenv("FIRESTORE_MAX_WORKERS", "16"))
+FIRESTORE_MAX_PENDING = int(os.getenv("FIRESTORE_MAX_PENDING", "256"))
+FIRESTORE_TIMEOUT_SECONDS = float(os.getenv("FIRESTORE_TIMEOUT_SECONDS", "10"))
+
+# Firestore rejects batches with more than 500 writes
+FIRESTORE_MAX_BATCH_WRITES = 500
+
+
+class FirestoreDAL:
+    """
+    Data-access layer for Firestore. The firebase-admin client is synchronous,
+    so every call runs on a dedicated, bounded thread pool instead of the event
+    loop. A semaphore caps the number of calls waiting for that pool, and every
+    call is bounded by a timeout.
+    """
+
+    def __init__(
+        self,
+        db,
+        max_workers: int = FIRESTORE_MAX_WORKERS,
+        max_pending: int = FIRESTORE_MAX_PENDING,
+        timeout: float = FIRESTORE_TIMEOUT_SECONDS,
+    ):
+        self.db = db
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="firestore"
+        )
+        self.semaphore = asyncio.Semaphore(max_pending)
+
+    async def run(self, fn, *args, timeout: Optional[float] = None, **kwargs):
+        """
+        Run a blocking Firestore call on the executor, bounded by a timeout.
+        A timed-out call keeps its semaphore slot until its thread finishes,
+        so calls stuck on the pool still count against FIRESTORE_MAX_PENDING.
+        """
+        await self.semaphore.acquire()
+        try:
+            loop = asyncio.get_running_loop()
+            future = loop.run_in_executor(self.executor, partial(fn, *args, **kwargs))
+        except BaseException:
+            self.semaphore.release()
+            raise
+        future.add_done_callback(self._release)
+        # Shielded, so the timeout abandons the call without marking it done
+        return await asyncio.wait_for(asyncio.shield(future), timeout or self.timeout)
+
+    def _release(self, future: asyncio.Future):
+        self.semaphore.release()
+        # Retrieve the error of a call nobody waits for any more
+        if not future.cancelled() and future.exception() is not None:
+            logging.debug(f"Firestore call failed: {future.exception()}")
+
+    def session_ref(self, chat_session_id: str):
+        return self.db.collection("sessions").document(chat_session_id)
+
+    def messages_ref(self, chat_session_id: str):
+        """Messages live in sessions/{id}/messages, one document per sequence number."""
+        return self.session_ref(chat_session_id).collection("messages")
+
+    def message_ref(self, chat_session_id: str, seq: int):
+        # Zero-padded IDs keep document order equal to sequence order
+        return self.messages_ref(chat_session_id).document(f"{seq:010d}")
+
+    def batch(self):
+        return self.db.batch()
+
+    async def commit(self, batch):
+        return await self.run(batch.commit)
+
+    async def get_session(self, chat_session_id: str) -> Optional[dict]:
+        """Return the session document as a dict, or None if it does not exist."""
+        session_doc = await self.run(self.session_ref(chat_session_id).get)
+        return session_doc.to_dict() if session_doc.exists else None
+
+    async def set_session(self, chat_session_id: str, data: dict, merge: bool = True):
+        await self.run(self.session_ref(chat_session_id).set, data, merge=merge)
+
+    async def create_session(self, chat_session_id: str, data: dict) -> bool:
+        """
+        Merge `data` into the session document unless the document already
+        names an owner. Returns whether data["userId"] owns the session; a
+        document the user already owns is left as it is. Runs as a
+        transaction, so two users can never both claim the same session.
+        """
+        session_ref = self.session_ref(chat_session_id)
+
+        @firestore.transactional
+        def claim(transaction) -> bool:
+            snapshot = session_ref.get(transaction=transaction)
+            session_dict = snapshot.to_dict() if snapshot.exists else None
+            owner = (session_dict or {}).get("userId")
+            if owner:
+                return owner == data["userId"]
+            transaction.set(session_ref, data, merge=True)
+            return True
+
+        return await self.run(claim, self.db.transaction())
+
+    async def update_session(self, chat_session_id: str, data: dict):
+        await self.run(self.session_ref(chat_session_id).update, data)
+
+    async def delete_session(self, chat_session_id: str):
+        """Delete the session document together with its messages subcollection."""
+        messages_ref = self.messages_ref(chat_session_id)
+        while True:
+            docs = await self.run(messages_ref.limit(FIRESTORE_MAX_BATCH_WRITES).get)
+            if not docs:
+                break
+            batch = self.batch()
+            for doc in docs:
+                batch.delete(doc.reference)
+            await self.commit(batch)
+        await self.run(self.session_ref(chat_session_id).delete)
+
+    async def get_messages(
+        self, chat_session_id: str, limit: int, before_seq: Optional[int] = None
+    ) -> List[dict]:
+        """
+        Return up to `limit` messages with a sequence number below `before_seq`
+        (or the latest ones), oldest first. Only the requested window is read.
+        """
+        query = self.messages_ref(chat_session_id).order_by(
+            "seq", direction=firestore.Query.DESCENDING
+        )
+        if before_seq is not None:
+            query = query.start_after({"seq": before_seq})
+        docs = await self.run(query.limit(limit).get)
+        return [doc.to_dict() for doc in reversed(docs)]
+
+    async def migrate_session_messages(
+        self, chat_session_id: str, session_dict: dict
+    ) -> dict:
+        """
+        Moves a legacy `chat_history` array into the messages subcollection and
+        leaves only summary fields on the session document. Safe to re-run:
+        message documents are keyed by sequence number.
+        """
+        history = session_dict.get("chat_history") or []
+        writes = []
+        for seq, message in enumerate(history, start=1):
+            message = {**message, "seq": message.get("seq", seq)}
+            writes.append((self.message_ref(chat_session_id, message["seq"]), message))
+
+        message_count = writes[-1][1]["seq"] if writes else 0
+        for start in range(0, len(writes), FIRESTORE_MAX_BATCH_WRITES):
+            batch = self.batch()
+            for ref, message in writes[start : start + FIRESTORE_MAX_BATCH_WRITES]:
+                batch.set(ref, message)
+            await self.commit(batch)
+
+        await self.update_session(
+            chat_session_id,
+            {"chat_history": firestore.DELETE_FIELD, "message_count": message_count},
+        )
+        logging.info(
+            f"✅ Migrated {len(writes)} messages of session {chat_session_id} to subcollection"
+        )
+
+        migrated = {k: v for k, v in session_dict.items() if k != "chat_history"}
+        migrated["message_count"] = message_count
+        return migrated
+
+    async def user_exists(self, user_id: str) -> bool:
+        user_doc = await self.run(self.db.collection("users").document(user_id).get)
+        return user_doc.exists
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        logging.info("❌ Firestore executor shut down")
@@ -0,0 +1,151 @@
+import asyncio
+import hashlib
+import logging
+import os
+import socket
+import time
+import uuid
+import zlib
+from typing import Set
+
+# Dirty-session events are split over a fixed number of shard streams by a hash
+# of the session ID. Each shard is flushed by exactly one replica at a time,
+# which holds a Redis lease on it; shards are assigned to live replicas by
+# rendezvous (highest random weight) hashing, so only the shards of a replica
+# that joins or leaves move.
+FLUSH_SHARDS = 16
+DIRTY_STREAM_KEY = "session_dirty:{}"
+SHARD_LEASE_KEY = "flush_shard_lease:{}"
+LEADER_LEASE_KEY = "flush_leader_lease"
+WORKERS_KEY = "flush_workers"
+
+LEASE_TTL_SECONDS = 15
+LEASE_RENEW_SECONDS = 5
+# A worker that has not sent a heartbeat for this long is considered gone
+WORKER_TIMEOUT_SECONDS = 3 * LEASE_RENEW_SECONDS
+
+# Extends or deletes a lease only if this worker still holds it
+RENEW_LEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+RELEASE_LEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+
+def shard_for(chat_session_id: str) -> int:
+    return zlib.crc32(chat_session_id.encode()) % FLUSH_SHARDS
+
+
+def dirty_stream_key(chat_session_id: str) -> str:
+    return DIRTY_STREAM_KEY.format(shard_for(chat_session_id))
+
+
+def _weight(worker_id: str, shard: int) -> int:
+    digest = hashlib.md5(f"{worker_id}:{shard}".encode()).digest()
+    return int.from_bytes(digest[:8], "big")
+
+
+def assign_shards(worker_ids, worker_id: str) -> Set[int]:
+    """Shards that rendezvous hashing assigns to `worker_id` among the live workers."""
+    return {
+        shard
+        for shard in range(FLUSH_SHARDS)
+        if max(worker_ids, key=lambda w: _weight(w, shard)) == worker_id
+    }
+
+
+class FlushCoordinator:
+    """
+    Keeps this replica's membership heartbeat, acquires and renews leases on
+    the flush shards assigned to it, releases shards that now belong to another
+    replica, and holds the leader lease used for cluster-wide maintenance.
+    """
+
+    def __init__(self, redis_instance):
+        self.redis = redis_instance
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+        self.shards: Set[int] = set()
+        self.is_leader = False
+        # Shards acquired since the flusher last looked; their pending events
+        # from the previous owner must be claimed
+        self.new_shards: Set[int] = set()
+
+    async def run(self):
+        logging.info(f"🚀 Flush coordinator started as {self.worker_id}")
+        while True:
+            try:
+                if self.redis is not None and await self.redis.ping():
+                    await self.refresh()
+            except Exception as e:
+                logging.error(f"❌ Error in flush coordinator: {e}")
+            await asyncio.sleep(LEASE_RENEW_SECONDS)
+
+    async def refresh(self):
+        now = time.time()
+        async with self.redis.pipeline(transaction=False) as pipe:
+            pipe.zadd(WORKERS_KEY, {self.worker_id: now})
+            pipe.zremrangebyscore(WORKERS_KEY, 0, now - WORKER_TIMEOUT_SECONDS)
+            pipe.zrange(WORKERS_KEY, 0, -1)
+            _, _, workers = await pipe.execute()
+
+        desired = assign_shards(workers or [self.worker_id], self.worker_id)
+        ttl_ms = LEASE_TTL_SECONDS * 1000
+
+        for shard in list(self.shards):
+            lease_key = SHARD_LEASE_KEY.format(shard)
+            if shard not in desired:
+                await self.redis.eval(RELEASE_LEASE_SCRIPT, 1, lease_key, self.worker_id)
+                self.shards.discard(shard)
+                logging.info(f"Released flush shard {shard} for rebalancing")
+            elif not await self.redis.eval(
+                RENEW_LEASE_SCRIPT, 1, lease_key, self.worker_id, ttl_ms
+            ):
+                self.shards.discard(shard)
+                logging.warning(f"⚠️ Lost lease on flush shard {shard}")
+
+        for shard in desired - self.shards:
+            if await self.redis.set(
+                SHARD_LEASE_KEY.format(shard), self.worker_id, nx=True, px=ttl_ms
+            ):
+                self.shards.add(shard)
+                self.new_shards.add(shard)
+                logging.info(f"Acquired flush shard {shard}")
+
+        if self.is_leader:
+            self.is_leader = bool(
+                await self.redis.eval(
+                    RENEW_LEASE_SCRIPT, 1, LEADER_LEASE_KEY, self.worker_id, ttl_ms
+                )
+            )
+        else:
+            self.is_leader = bool(
+                await self.redis.set(
+                    LEADER_LEASE_KEY, self.worker_id, nx=True, px=ttl_ms
+                )
+            )
+
+    async def stop(self):
+        """Hands leases back immediately so other replicas rebalance without waiting for expiry."""
+        if self.redis is None:
+            return
+        try:
+            for shard in self.shards:
+                await self.redis.eval(
+                    RELEASE_LEASE_SCRIPT, 1, SHARD_LEASE_KEY.format(shard), self.worker_id
+                )
+            if self.is_leader:
+                await self.redis.eval(
+                    RELEASE_LEASE_SCRIPT, 1, LEADER_LEASE_KEY, self.worker_id
+                )
+            await self.redis.zrem(WORKERS_KEY, self.worker_id)
+        except Exception as e:
+            logging.error(f"❌ Failed to release flush leases: {e}")
+        self.shards.clear()
+        self.is_leader = False
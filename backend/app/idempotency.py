@@ -0,0 +1,89 @@
+import asyncio
+import hashlib
+import json
+import logging
+from typing import Optional, Tuple
+
+from .turn_stream import TURN_STREAM_KEY, TURN_STREAM_TTL_SECONDS
+
+# A chat turn is recorded under an idempotency key when it starts, so retries
+# and double submissions attach to the running turn instead of starting
+# another generation. Clients may send their own key; otherwise it is derived
+# from the session and the message, and only kept briefly so that asking the
+# same question again later still starts a new turn.
+IDEMPOTENCY_KEY = "chat_idempotency:{}:{}"
+# A finished turn is only replayable while its event stream lives
+IDEMPOTENCY_TTL_SECONDS = TURN_STREAM_TTL_SECONDS
+DERIVED_IDEMPOTENCY_TTL_SECONDS = 30
+MAX_CLIENT_KEY_LENGTH = 128
+
+# A running turn keeps its record alive; one left by a crashed worker
+# expires shortly after, so retries are not blocked for long
+IN_FLIGHT_TTL_SECONDS = 30
+IN_FLIGHT_REFRESH_SECONDS = 10
+
+
+def idempotency_key(
+    user_id: str, chat_session_id: str, message: str, client_key: Optional[str] = None
+) -> Tuple[str, int]:
+    """Return the Redis key recording the turn and how long to keep it once done."""
+    if client_key:
+        return (
+            IDEMPOTENCY_KEY.format(user_id, client_key[:MAX_CLIENT_KEY_LENGTH]),
+            IDEMPOTENCY_TTL_SECONDS,
+        )
+    digest = hashlib.sha256(f"{chat_session_id}\0{message}".encode()).hexdigest()
+    return IDEMPOTENCY_KEY.format(user_id, digest), DERIVED_IDEMPOTENCY_TTL_SECONDS
+
+
+async def claim_turn(
+    redis_instance, key: str, chat_session_id: str, turn_id: str
+) -> Optional[dict]:
+    """
+    Records the turn as in flight. Returns None if this request owns the
+    turn, or the existing record ({chat_session_id, turn_id, state}) if it
+    duplicates one. A done turn whose events have expired is claimed anew.
+    """
+    record = {"chat_session_id": chat_session_id, "turn_id": turn_id, "state": "in_flight"}
+    for _ in range(3):
+        if await redis_instance.set(
+            key, json.dumps(record), nx=True, ex=IN_FLIGHT_TTL_SECONDS
+        ):
+            return None
+        existing = await redis_instance.get(key)
+        if not existing:
+            continue  # The record expired in between; try to claim it again
+        existing = json.loads(existing)
+        if existing["state"] == "done" and not await redis_instance.exists(
+            TURN_STREAM_KEY.format(existing["turn_id"])
+        ):
+            # Nothing is left to replay
+            await redis_instance.delete(key)
+            continue
+        return existing
+    return None
+
+
+async def keep_turn_claimed(redis_instance, key: str):
+    """Refreshes the in-flight record of a running turn until cancelled."""
+    while True:
+        await asyncio.sleep(IN_FLIGHT_REFRESH_SECONDS)
+        try:
+            await redis_instance.expire(key, IN_FLIGHT_TTL_SECONDS)
+        except Exception as e:
+            logging.error(f"❌ Failed refreshing turn record {key}: {e}")
+
+
+async def finish_turn(
+    redis_instance, key: str, record: dict, completed: bool, ttl: int
+):
+    """
+    Marks a turn as done for `ttl` seconds so later duplicates replay it, or
+    forgets a failed turn so a retry runs it again.
+    """
+    if completed:
+        await redis_instance.set(
+            key, json.dumps({**record, "state": "done"}), xx=True, ex=ttl
+        )
+    else:
+        await redis_instance.delete(key)
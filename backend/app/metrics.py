@@ -0,0 +1,119 @@
+import logging
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from fastapi import APIRouter
+from fastapi.responses import Response
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+)
+
+# Request ID of the HTTP request being served; background tasks created while
+# handling it inherit the value, so their logs carry the same ID.
+request_id_var: ContextVar[str] = ContextVar("request_id", default="-")
+
+STAGE_DURATION = Histogram(
+    "versa_stage_duration_seconds",
+    "Duration of chat and ingestion pipeline stages",
+    ["stage"],
+    buckets=(
+        0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+        1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0,
+    ),
+)
+STAGE_ERRORS = Counter(
+    "versa_stage_errors_total",
+    "Pipeline stages that raised an exception",
+    ["stage"],
+)
+CHAT_TURNS = Counter(
+    "versa_chat_turns_total",
+    "Chat turns by outcome",
+    ["outcome"],
+)
+
+SSE_SUBSCRIBERS_DROPPED = Counter(
+    "versa_sse_subscribers_dropped_total",
+    "SSE clients disconnected for falling behind their event queue",
+)
+
+WS_CONNECTIONS = Gauge(
+    "versa_ws_connections",
+    "Open chat WebSocket connections",
+)
+WS_SUBSCRIPTIONS_DROPPED = Counter(
+    "versa_ws_subscriptions_dropped_total",
+    "WebSocket session subscriptions dropped for falling behind",
+)
+
+metrics_router = APIRouter()
+
+
+def observe(stage: str, seconds: float):
+    STAGE_DURATION.labels(stage).observe(seconds)
+
+
+@contextmanager
+def timed(stage: str):
+    """Records the duration of the enclosed block (sync or awaited) under a stage label."""
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        STAGE_ERRORS.labels(stage).inc()
+        raise
+    finally:
+        observe(stage, time.perf_counter() - start)
+
+
+class RequestIdFilter(logging.Filter):
+    """Adds the current request ID to every log record."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        record.request_id = request_id_var.get()
+        return True
+
+
+class RequestIdMiddleware:
+    """
+    ASGI middleware that takes the request ID from the X-Request-ID header
+    (or generates one), exposes it to logging and echoes it in the response.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] not in ("http", "websocket"):
+            return await self.app(scope, receive, send)
+
+        request_id = None
+        for name, value in scope.get("headers", []):
+            if name == b"x-request-id":
+                request_id = value.decode("latin-1")[:64]
+                break
+        request_id = request_id or uuid.uuid4().hex[:16]
+        token = request_id_var.set(request_id)
+
+        async def send_with_request_id(message):
+            if message["type"] == "http.response.start":
+                headers = list(message.get("headers", []))
+                headers.append((b"x-request-id", request_id.encode("latin-1")))
+                message["headers"] = headers
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_request_id)
+        finally:
+            request_id_var.reset(token)
+
+
+@metrics_router.get("/metrics")
+async def metrics():
+    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
@@ -1,6 +1,7 @@
 import logging
 import os
-from typing import List, Dict, Any
+from operator import itemgetter
+from typing import List, Dict, Any, Tuple
 
 from dotenv import load_dotenv
 from langchain_pinecone import PineconeVectorStore
@@ -11,12 +12,14 @@ from langchain.schema import (
 )
 from langchain.prompts import ChatPromptTemplate
 from langchain_core.runnables import (
-    RunnablePassthrough,
     RunnableLambda,
 )  # Import RunnableParallel
 from langchain_google_genai import ChatGoogleGenerativeAI
 from langchain_openai import ChatOpenAI
 from langchain_core.retrievers import BaseRetriever
+from langchain_core.embeddings import Embeddings
+
+from .metrics import timed
 
 
 load_dotenv()
@@ -33,7 +36,46 @@ if not os.getenv("VOYAGE_API_KEY"):
 if not os.getenv("PINECONE_API_KEY"):
     logging.warning("PINECONE_API_KEY environment variable not set.")
 
-embeddings = VoyageAIEmbeddings(model="voyage-3")
+
+
+class TimedEmbeddings(Embeddings):
+    """Delegates to another embeddings model, recording query and document embedding latency."""
+
+    def __init__(self, inner: Embeddings):
+        self.inner = inner
+
+    def embed_query(self, text: str) -> List[float]:
+        with timed("embed_query"):
+            return self.inner.embed_query(text)
+
+    async def aembed_query(self, text: str) -> List[float]:
+        with timed("embed_query"):
+            return await self.inner.aembed_query(text)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        with timed("embed_documents"):
+            return self.inner.embed_documents(texts)
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        with timed("embed_documents"):
+            return await self.inner.aembed_documents(texts)
+
+
+embeddings = TimedEmbeddings(VoyageAIEmbeddings(model="voyage-3"))
+
+
+def timed_retriever(retriever: BaseRetriever) -> RunnableLambda:
+    """Wraps a retriever so each Pinecone retrieval is recorded as a stage."""
+
+    def retrieve(query: str) -> List[Document]:
+        with timed("retrieval"):
+            return retriever.invoke(query)
+
+    async def aretrieve(query: str) -> List[Document]:
+        with timed("retrieval"):
+            return await retriever.ainvoke(query)
+
+    return RunnableLambda(retrieve, afunc=aretrieve)
 
 
 # The get_retriever function does not need changes
@@ -182,6 +224,33 @@ def format_docs_with_metadata(docs: List[Document]) -> str:
     return formatted_string
 
 
+# Length of the document excerpt sent with each source
+SOURCE_SNIPPET_CHARS = 200
+
+
+def sources_from_docs(docs: List[Document]) -> List[Dict[str, Any]]:
+    """
+    Returns the citation data of the retrieved documents (page, segment and a
+    short snippet), in retrieval order and without duplicate segments.
+    """
+    sources = []
+    seen = set()
+    for doc in docs:
+        page = doc.metadata.get("page")
+        if isinstance(page, float):
+            page = int(page)
+        segment = doc.metadata.get("segment")
+        if (page, segment) in seen:
+            continue
+        seen.add((page, segment))
+
+        snippet = " ".join(doc.page_content.split())
+        if len(snippet) > SOURCE_SNIPPET_CHARS:
+            snippet = snippet[:SOURCE_SNIPPET_CHARS].rstrip() + "…"
+        sources.append({"page": page, "segment": segment, "snippet": snippet})
+    return sources
+
+
 # --- Corrected create_chain function signature and chain definition ---
 def create_chain(
     chat_history: List[str],  # Keep this parameter - it's provided by chat_send
@@ -191,7 +260,14 @@ def create_chain(
     mode: str = "auto",
     demo: bool = False,
     isNewSession: bool = False,
-):
+    summary: str = "",
+) -> Tuple[RunnableLambda, Any]:
+    """
+    Returns the retriever and the answer chain as separate runnables, so the
+    caller can publish the sources before generation starts. The retriever
+    takes the query; the answer chain takes {"docs": <retrieved documents>,
+    "question": <query>}.
+    """
     mode = mode if mode in {"similarity", "mmr", "hybrid"} else "auto"
 
     index_name = "versa-ai-demo" if demo else "versa-ai-voyage"
@@ -223,8 +299,11 @@ Instructions:
 1.  **Prioritize Context:** Base your answer strictly on the 'Retrieved Documents'. Do not add information not found there unless the documents explicitly lack the necessary information to answer the question *at all*.
 2.  **Cite Sources:** When you use information from the 'Retrieved Documents', include the source citation (e.g., (p.3) or (p.3, 1/2)) that precedes the relevant text in the document section. If information comes from multiple sources, cite all relevant ones. Place the citation at the end of the sentence or paragraph that uses the information.
 3.  **Acknowledge Gaps:** If the documents do not contain the answer, state that clearly (e.g., "The provided documents don't contain information about X.").
-4.  **Use Chat History:** Refer to the 'Chat History' to maintain conversational context and build upon previous turns.
+4.  **Use Chat History:** Refer to the 'Conversation Summary' and 'Chat History' to maintain conversational context and build upon previous turns.
 
+---
+Conversation Summary (earlier turns):
+{summary}
 ---
 Chat History:
 {chat_history}
@@ -266,27 +345,25 @@ Answer:
 
     logging.info("Building retrieval chain...")
 
-    # --- Corrected Chain Definition ---
-    # This chain expects a single string input (the user question or refined query)
-    retrieval_chain = (
+    # --- Chain Definition ---
+    # Retrieval runs on its own; the answer chain receives its documents
+    answer_chain = (
         {
-            # The RunnablePassthrough() here means the input string (the query) is passed to the retriever.
-            # The output of the retriever (List[Document]) is then passed to format_docs_with_metadata.
-            # The string output of format_docs_with_metadata is assigned to 'context'.
-            "context": RunnablePassthrough()
-            | retriever
-            | RunnableLambda(format_docs_with_metadata),
+            # The retrieved documents (List[Document]) are formatted with
+            # their citations and assigned to 'context'.
+            "context": itemgetter("docs") | RunnableLambda(format_docs_with_metadata),
             # This Lambda ignores the chain's input string and uses the chat_history variable
             # from the enclosing scope of the create_chain function.
             # This is the key to using the history passed directly to create_chain.
             "chat_history": RunnableLambda(lambda x: chat_history),
-            # The RunnablePassthrough() here means the chain's input string (the query)
-            # is passed through and assigned to 'question'.
-            "question": RunnablePassthrough(),
+            # Rolling summary of turns that no longer fit in the chat history
+            "summary": RunnableLambda(lambda x: summary or "None"),
+            # The query the documents were retrieved for
+            "question": itemgetter("question"),
         }
         | prompt
         | model
     )
 
     logging.info("Retrieval chain created successfully.")
-    return retrieval_chain
+    return timed_retriever(retriever), answer_chain
@@ -0,0 +1,141 @@
+import asyncio
+import json
+import logging
+import uuid
+from typing import Dict, Optional, Set
+
+from .turn_stream import publish_turn_event
+
+# Events buffered per SSE client. A client that falls this far behind is
+# disconnected rather than allowed to grow memory without bound.
+SUBSCRIBER_QUEUE_SIZE = 1024
+
+# Put on a subscriber's queue when it was dropped for falling behind
+STREAM_OVERFLOW = object()
+
+
+class PubSubMultiplexer:
+    """
+    One Redis pub/sub connection per process, shared by every SSE stream.
+    Channels are subscribed while at least one local client listens to them;
+    each published event is decoded once and fanned out to the clients'
+    bounded queues. It also serves as the local channel registry: events
+    published from this process reach local clients directly, and go through
+    Redis pub/sub only when another process listens.
+    """
+
+    def __init__(self, redis_instance, queue_size: int = SUBSCRIBER_QUEUE_SIZE):
+        self.redis = redis_instance
+        self.queue_size = queue_size
+        self.pubsub = redis_instance.pubsub() if redis_instance else None
+        self.subscribers: Dict[str, Set[asyncio.Queue]] = {}
+        # Channels whose subscription Redis has confirmed, i.e. that Redis
+        # counts this process as a subscriber of
+        self.confirmed: Set[str] = set()
+        # Tags events published from this process so the reader skips them
+        self.origin = uuid.uuid4().hex[:12]
+        self.lock = asyncio.Lock()
+        # Set while any channel is subscribed; the reader idles otherwise
+        self.active = asyncio.Event()
+
+    async def subscribe(self, channel: str) -> asyncio.Queue:
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        async with self.lock:
+            subscribers = self.subscribers.get(channel)
+            if subscribers is None:
+                subscribers = self.subscribers[channel] = set()
+                await self.pubsub.subscribe(channel)
+                self.active.set()
+            subscribers.add(queue)
+        return queue
+
+    async def unsubscribe(self, channel: str, queue: asyncio.Queue):
+        async with self.lock:
+            subscribers = self.subscribers.get(channel)
+            if subscribers is None:
+                return
+            subscribers.discard(queue)
+            if not subscribers:
+                del self.subscribers[channel]
+                await self.pubsub.unsubscribe(channel)
+                if not self.subscribers:
+                    self.active.clear()
+
+    async def has_listeners(self, channel: str) -> bool:
+        """Whether any process, this one included, has a client on the channel."""
+        if self.subscribers.get(channel):
+            return True
+        (_, count), = await self.redis.pubsub_numsub(channel)
+        # An unsubscribe of this process may still be in flight
+        return count - (1 if channel in self.confirmed else 0) > 0
+
+    def is_local(self, channel: str) -> bool:
+        return channel in self.confirmed and bool(self.subscribers.get(channel))
+
+    async def publish(self, channel: str, payload: dict, turn_id: Optional[str] = None):
+        """Deliver an event to local subscribers directly and to remote ones via Redis."""
+        if turn_id:
+            entry_id = await publish_turn_event(
+                self.redis,
+                channel,
+                turn_id,
+                payload,
+                origin=self.origin,
+                locally_subscribed=self.is_local(channel),
+            )
+            payload = {"id": f"{turn_id}/{entry_id}", **payload}
+        else:
+            await self.redis.publish(channel, json.dumps({**payload, "o": self.origin}))
+        self.dispatch(channel, payload)
+
+    def dispatch(self, channel: str, data):
+        for queue in list(self.subscribers.get(channel, ())):
+            try:
+                queue.put_nowait(data)
+            except asyncio.QueueFull:
+                # Slow consumer: drop it and tell its stream to close; the
+                # transport reading the queue counts the drop
+                self.subscribers[channel].discard(queue)
+                queue.get_nowait()
+                queue.put_nowait(STREAM_OVERFLOW)
+                logging.warning(f"⚠️ Dropped slow subscriber on {channel}")
+
+    async def run(self):
+        logging.info("🚀 Pub/Sub multiplexer started")
+        while True:
+            try:
+                await self.active.wait()
+                message = await self.pubsub.get_message(timeout=1.0)
+                if not message:
+                    continue
+                if message["type"] == "subscribe":
+                    self.confirmed.add(message["channel"])
+                elif message["type"] == "unsubscribe":
+                    self.confirmed.discard(message["channel"])
+                elif message["type"] == "message":
+                    data = json.loads(message["data"])
+                    # Events from this process were already delivered locally
+                    if data.pop("o", None) != self.origin:
+                        self.dispatch(message["channel"], data)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"❌ Error in pub/sub multiplexer: {e}")
+                await asyncio.sleep(1)
+                await self.resubscribe()
+
+    async def resubscribe(self):
+        """Replaces a failed pub/sub connection and restores its subscriptions."""
+        async with self.lock:
+            try:
+                await self.pubsub.close()
+            except Exception:
+                pass
+            self.pubsub = self.redis.pubsub()
+            self.confirmed.clear()
+            if self.subscribers:
+                await self.pubsub.subscribe(*self.subscribers)
+
+    async def close(self):
+        if self.pubsub is not None:
+            await self.pubsub.close()
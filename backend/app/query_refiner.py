@@ -6,6 +6,7 @@ from typing import List
 from langchain_google_genai import ChatGoogleGenerativeAI
 from langchain_core.prompts import ChatPromptTemplate, MessagesPlaceholder
 from langchain_core.messages import SystemMessage, BaseMessage
+from .metrics import timed
 
 # --- Constants ---
 # Define the system prompt centrally
@@ -75,9 +76,10 @@ async def refine_user_query(
         logger.info(f"Refining query '{query}' using history.")
         refinement_start_time = time.time()
 
-        refined_query_result = await refine_chain.ainvoke(
-            {"chat_history": chat_history, "query": query}
-        )
+        with timed("refine_query"):
+            refined_query_result = await refine_chain.ainvoke(
+                {"chat_history": chat_history, "query": query}
+            )
         refined_query = refined_query_result.content  # Extract the string content
         refinement_duration = time.time() - refinement_start_time
         logger.info(f"✨ Original query: '{query}'")
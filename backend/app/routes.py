@@ -1,19 +1,41 @@
-from fastapi import APIRouter, Request, status, HTTPException, Depends
-from fastapi.responses import JSONResponse, StreamingResponse
+from fastapi import APIRouter, Request, status, HTTPException, Depends, Query
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from pydantic import BaseModel
 import json
 import asyncio
 import logging
 import time
-from typing import Optional, List
+from typing import Optional, List, Tuple
 
 # Your existing imports
-from .pinecone_retriever_chain import create_chain
-from firebase_admin import firestore
+from .pinecone_retriever_chain import create_chain, sources_from_docs
 from .verify_access import get_current_user
 from .basic_chain import generate_chat_title
 from .query_refiner import refine_user_query
-from .stream_with_indentation_fix import stream_with_indentation_fix
+from .stream_with_indentation_fix import (
+    extract_chunk_text,
+    stream_with_indentation_fix,
+)
+from .summarizer import maybe_summarize_session
+from .metrics import CHAT_TURNS, SSE_SUBSCRIBERS_DROPPED, observe, timed
+from .token_budget import history_token_budget, select_history_window
+from .session_manager_firebase import HISTORY_CACHE_WINDOW
+from .pubsub_multiplexer import STREAM_OVERFLOW, PubSubMultiplexer
+from .chunk_coalescer import ChunkCoalescer
+from .idempotency import (
+    IDEMPOTENCY_TTL_SECONDS,
+    claim_turn,
+    finish_turn,
+    idempotency_key,
+    keep_turn_claimed,
+)
+from .turn_stream import (
+    entry_order,
+    new_turn_id,
+    parse_event_id,
+    publish_turn_event,
+    read_turn_events,
+)
 from slowapi import Limiter
 from slowapi.util import get_remote_address
 
@@ -29,6 +51,17 @@ limiter = Limiter(key_func=get_remote_address)
 
 message_queues = {}
 
+# Page size of the history endpoint; the largest page fits the Redis window
+HISTORY_PAGE_DEFAULT = 50
+HISTORY_PAGE_MAX = HISTORY_CACHE_WINDOW
+
+# Title of a new session until its generated title is stored
+NEW_SESSION_TITLE = "New Chat"
+
+# Generation stops once no client has listened to the turn for this long
+LISTENER_GRACE_SECONDS = 10
+LISTENER_CHECK_INTERVAL_SECONDS = 1
+
 
 class MessageRequest(BaseModel):
     message: str
@@ -38,6 +71,7 @@ class MessageRequest(BaseModel):
     isNewSession: Optional[bool] = False
     model: Optional[str] = None
     retrievalMethod: Optional[str] = "auto"
+    idempotencyKey: Optional[str] = None
 
 
 class PDFIngestRequest(BaseModel):
@@ -48,9 +82,9 @@ class PDFIngestRequest(BaseModel):
 async def verify_user(user_id: str) -> bool:
     """Check if the user exists in Firestore."""
     try:
-        user_ref = firestore.client().collection("users").document(user_id)
-        user_doc = user_ref.get()
-        return user_doc.exists
+        from .db import firestore_dal
+
+        return await firestore_dal.user_exists(user_id)
     except Exception as e:
         logging.error(f"❌ Error verifying user in Firestore: {e}")
         return False
@@ -74,16 +108,376 @@ async def upsert_pdf(
     )
 
 
-@router.post("/chat_send")
-@limiter.limit("30/minute")
-async def chat_send(
-    request: Request,
-    message_request: MessageRequest,
-    user_id_from_token: str = Depends(get_current_user),  # Authenticated user ID
+async def publish_event(
+    redis_instance,
+    chat_session_id: str,
+    payload: dict,
+    turn_id: Optional[str] = None,
+    multiplexer: Optional[PubSubMultiplexer] = None,
+):
+    """
+    Publish a single event on the session's chat channel. Events of a turn
+    are also recorded in the turn's stream so clients can replay them. With
+    the process's multiplexer, local streams get the event directly and Redis
+    only fans it out to other processes that listen.
+    """
+    payload.setdefault("timestamp", time.time())
+    channel = f"chat:{chat_session_id}"
+    with timed("redis_publish"):
+        if multiplexer is not None:
+            await multiplexer.publish(channel, payload, turn_id)
+        elif turn_id:
+            await publish_turn_event(redis_instance, channel, turn_id, payload)
+        else:
+            await redis_instance.publish(channel, json.dumps(payload))
+
+
+async def title_new_session(
+    session_manager,
+    redis_instance,
+    chat_session_id: str,
+    user_message: str,
+    turn_id: Optional[str] = None,
+    multiplexer: Optional[PubSubMultiplexer] = None,
+):
+    """
+    Generates the title of a new session, whose document was created by
+    chat_send, and stores it. Runs off the request path; the title reaches
+    the client as a "title" event on the chat stream.
+    """
+    title = await generate_chat_title(user_message)
+    try:
+        await session_manager.update_session_title(chat_session_id, title)
+    except Exception as e:
+        logging.error(f"❌ Failed to store title for {chat_session_id}: {e}")
+        return
+
+    try:
+        await publish_event(
+            redis_instance,
+            chat_session_id,
+            {"type": "title", "content": title},
+            turn_id,
+            multiplexer,
+        )
+    except Exception as e:
+        logging.error(f"❌ Failed publishing title for {chat_session_id}: {e}")
+
+
+def build_langchain_history(
+    chat_history_dicts: List[dict], model: Optional[str]
+) -> List[BaseMessage]:
+    """Selects the recent history window by token budget and converts it to messages."""
+    recent_history = select_history_window(
+        chat_history_dicts, history_token_budget(model)
+    )
+
+    langchain_history = []
+    for entry in recent_history:
+        role = entry.get("role")
+        content = entry.get("content", "")
+        if role == "human":
+            langchain_history.append(HumanMessage(content=content))
+        elif role == "ai":
+            langchain_history.append(AIMessage(content=content))
+    return langchain_history
+
+
+async def cancel_when_unheard(
+    multiplexer: PubSubMultiplexer,
+    channel: str,
+    task: asyncio.Task,
+    abandoned: asyncio.Event,
 ):
     """
-    Handles sending a chat message, refining the query, processing with history,
-    and initiating the streaming response via Redis Pub/Sub.
+    Cancels `task` once no client anywhere has listened to the channel for
+    LISTENER_GRACE_SECONDS, setting `abandoned` first. The grace period covers
+    the gap between /chat_send returning and the stream connecting, as well as
+    brief reconnects.
+    """
+    unheard_since = None
+    while not task.done():
+        await asyncio.sleep(LISTENER_CHECK_INTERVAL_SECONDS)
+        try:
+            listening = await multiplexer.has_listeners(channel)
+        except Exception as e:
+            logging.error(f"❌ Failed checking listeners on {channel}: {e}")
+            listening = True
+        if listening:
+            unheard_since = None
+            continue
+        now = time.monotonic()
+        unheard_since = unheard_since or now
+        if now - unheard_since >= LISTENER_GRACE_SECONDS:
+            abandoned.set()
+            task.cancel()
+            return
+
+
+async def publish_response(
+    session_manager,
+    redis_instance,
+    retriever,
+    answer_chain,
+    refined_query: str,
+    chat_session_id: str,
+    user_id: str,
+    pdf_id: str,
+    turn_id: Optional[str] = None,
+    multiplexer: Optional[PubSubMultiplexer] = None,
+):
+    """
+    Retrieves the documents and publishes their sources, then streams the
+    answer to the chat channel and stores the AI response. Returns whether
+    the turn completed (possibly truncated) without an error.
+    """
+
+    async def publish_chunks(text: str):
+        await publish_event(
+            redis_instance,
+            chat_session_id,
+            {"type": "chunk", "content": text},
+            turn_id,
+            multiplexer,
+        )
+
+    coalescer = ChunkCoalescer(publish_chunks)
+    original_chunks = []
+    generated = False
+    generation_start = time.perf_counter()
+
+    async def stream_answer():
+        nonlocal generated, generation_start
+        # Citations reach the client before the first token
+        docs = await retriever.ainvoke(refined_query)
+        await publish_event(
+            redis_instance,
+            chat_session_id,
+            {"type": "sources", "sources": sources_from_docs(docs)},
+            turn_id,
+            multiplexer,
+        )
+        # LLM timings start once the sources are out, so they exclude retrieval
+        generation_start = time.perf_counter()
+
+        first_token_seen = False
+        async for orig_chunk, proc_item in stream_with_indentation_fix(
+            answer_chain.astream({"docs": docs, "question": refined_query})
+        ):
+            if not first_token_seen:
+                first_token_seen = True
+                observe("llm_first_token", time.perf_counter() - generation_start)
+            # Extract original text
+            text = extract_chunk_text(orig_chunk)
+            if text:
+                original_chunks.append(text)
+
+            if isinstance(proc_item, str):
+                generated = True
+                await coalescer.add(proc_item)
+            # ignore non-str items for now
+
+        # Flush remaining chunks
+        await coalescer.close()
+
+    # Generation is cancelled once nobody has listened for a grace period
+    stream_task = asyncio.create_task(stream_answer())
+    abandoned = asyncio.Event()
+    watcher = None
+    if multiplexer is not None:
+        watcher = asyncio.create_task(
+            cancel_when_unheard(
+                multiplexer, f"chat:{chat_session_id}", stream_task, abandoned
+            )
+        )
+
+    truncated = False
+    try:
+        await stream_task
+    except asyncio.CancelledError:
+        if not abandoned.is_set():
+            stream_task.cancel()
+            raise
+        truncated = True
+        coalescer.cancel()
+        logging.info(
+            f"✂️ No listeners for session {chat_session_id}, generation cancelled"
+        )
+    except Exception as stream_err:
+        logging.exception(
+            f"❌ Error streaming response for session {chat_session_id}: {stream_err}"
+        )
+        CHAT_TURNS.labels("error").inc()
+        coalescer.cancel()
+        # Notify frontend of error
+        try:
+            await publish_event(
+                redis_instance,
+                chat_session_id,
+                {
+                    "type": "error",
+                    "content": f"Error processing response: {stream_err}",
+                },
+                turn_id,
+                multiplexer,
+            )
+        except Exception as pub_err:
+            logging.error(f"❌ Failed publishing error event: {pub_err}")
+        return False  # abort further processing
+    finally:
+        if watcher is not None:
+            watcher.cancel()
+
+    observe("llm_total", time.perf_counter() - generation_start)
+    CHAT_TURNS.labels("abandoned" if truncated else "completed").inc()
+
+    # Signal completion; a client replaying the turn later learns it was cut short
+    complete_event = {"type": "complete"}
+    if truncated:
+        complete_event["truncated"] = True
+    await publish_event(
+        redis_instance, chat_session_id, complete_event, turn_id, multiplexer
+    )
+
+    # Store full AI response (or what was generated before cancelling)
+    if generated:
+        full = "".join(original_chunks)
+        await session_manager.add_message(
+            chat_session_id, user_id, pdf_id, "ai", full, truncated=truncated
+        )
+        logging.info(f"Full AI response stored for session {chat_session_id}")
+        asyncio.create_task(
+            maybe_summarize_session(session_manager, redis_instance, chat_session_id)
+        )
+    else:
+        logging.warning(f"No AI content generated for session {chat_session_id}")
+    return True
+
+
+async def process_chat_turn(
+    session_manager,
+    redis_instance,
+    chat_session_id: str,
+    user_id: str,
+    pdf_id: str,
+    user_message: str,
+    model: Optional[str],
+    retrieval_method: str,
+    is_new_session: bool,
+    turn_id: Optional[str] = None,
+    multiplexer: Optional[PubSubMultiplexer] = None,
+    turn_key: Optional[str] = None,
+    turn_key_ttl: int = IDEMPOTENCY_TTL_SECONDS,
+):
+    """
+    Runs one chat turn in the background: fetches history, then refines the
+    query, persists the user message and builds the chain concurrently, and
+    finally streams the answer.
+    """
+    completed = False
+    # The turn's in-flight record lives as long as the turn runs
+    claim_keeper = (
+        asyncio.create_task(keep_turn_claimed(redis_instance, turn_key))
+        if turn_key
+        else None
+    )
+    try:
+        try:
+            # A new session has no history yet, so skip the Firestore read
+            if is_new_session:
+                chat_history_dicts, summary = [], {}
+            else:
+                chat_history_dicts, summary = await asyncio.gather(
+                    session_manager.get_recent_messages(chat_session_id),
+                    session_manager.get_summary(chat_session_id),
+                )
+            # Only the cached tail is read; turns folded into the rolling
+            # summary reach the chain through it
+            summary_upto = summary.get("summary_upto", 0)
+            langchain_history = build_langchain_history(
+                [m for m in chat_history_dicts if m.get("seq", 0) > summary_upto], model
+            )
+            langchain_history_for_chain = langchain_history + [
+                HumanMessage(content=user_message)
+            ]
+
+            refined_query, _, (retriever, answer_chain) = await asyncio.gather(
+                refine_user_query(
+                    chat_history=langchain_history,
+                    query=user_message,
+                    logger=logging,
+                ),
+                session_manager.add_message(
+                    chat_session_id, user_id, pdf_id, "human", user_message
+                ),
+                # create_chain connects to Pinecone synchronously
+                asyncio.to_thread(
+                    create_chain,
+                    chat_history=langchain_history_for_chain,
+                    summary=summary.get("summary", ""),
+                    user_id=user_id,
+                    pdf_id=pdf_id,
+                    preferred_model=model,
+                    mode=retrieval_method,
+                    isNewSession=is_new_session,
+                ),
+            )
+        except Exception as e:
+            logging.exception(
+                f"❌ Error preparing chat turn for session {chat_session_id}: {e}"
+            )
+            CHAT_TURNS.labels("error").inc()
+            try:
+                await publish_event(
+                    redis_instance,
+                    chat_session_id,
+                    {"type": "error", "content": f"Error processing message: {e}"},
+                    turn_id,
+                    multiplexer,
+                )
+            except Exception as pub_err:
+                logging.error(f"❌ Failed publishing error event: {pub_err}")
+            return
+
+        completed = await publish_response(
+            session_manager,
+            redis_instance,
+            retriever,
+            answer_chain,
+            refined_query,
+            chat_session_id,
+            user_id,
+            pdf_id,
+            turn_id,
+            multiplexer,
+        )
+    finally:
+        # Later duplicates of a completed turn replay it; a failed turn may be retried
+        if turn_key:
+            claim_keeper.cancel()
+            try:
+                await finish_turn(
+                    redis_instance,
+                    turn_key,
+                    {"chat_session_id": chat_session_id, "turn_id": turn_id},
+                    completed,
+                    turn_key_ttl,
+                )
+            except Exception as e:
+                logging.error(f"❌ Failed recording turn {turn_id} as finished: {e}")
+
+
+async def start_chat_turn(
+    app_state,
+    message_request: MessageRequest,
+    user_id_from_token: str,
+    client_key: Optional[str] = None,
+) -> Tuple[int, dict]:
+    """
+    Validates a chat message and schedules title generation and the chat
+    turn in the background. Returns the status code and body of the reply;
+    the answer itself is streamed via Redis Pub/Sub. Shared by /chat_send
+    and the WebSocket transport.
     """
     # Unpack request
     user_message = message_request.message
@@ -105,26 +499,12 @@ async def chat_send(
         logging.error(
             f"Unauthorized: Token user {user_id_from_token}, " f"Request user {user_id}"
         )
-        return JSONResponse(
-            status_code=status.HTTP_401_UNAUTHORIZED,
-            content={"error": "Unauthorized user or user ID mismatch"},
-        )
-
-    # --- New Session Handling ---
-    session_manager = request.app.state.session_manager_firebase
-    new_title = None
-    if isNewSession:
-        new_title = await generate_chat_title(user_message)
-        await session_manager.create_session(
-            chat_session_id, user_id, pdf_id, initial_title="New Chat"
-        )
-        # Update title in the background
-        asyncio.create_task(
-            session_manager.update_session_title(chat_session_id, new_title)
-        )
+        return status.HTTP_401_UNAUTHORIZED, {
+            "error": "Unauthorized user or user ID mismatch"
+        }
 
     # --- Redis Connection ---
-    redis_instance = request.app.state.redis_instance
+    redis_instance = app_state.redis_instance
     if redis_instance is None:
         logging.error("❌ Redis instance is unavailable.")
         raise HTTPException(
@@ -132,237 +512,308 @@ async def chat_send(
             detail="Internal Server Error: Could not connect to Redis",
         )
 
-    # --- Fetch & Prepare History ---
-    chat_history_dicts = await session_manager.get_history(chat_session_id)
-    word_count = 0
-    recent_history = []
-    for entry in reversed(chat_history_dicts):
-        if len(recent_history) >= 10 and word_count >= 1000:
-            break
-        content = entry.get("content", "")
-        wc = len(content.split())
-        if word_count + wc > 1000 and len(recent_history) >= 4:
-            break
-        recent_history.append(entry)
-        word_count += wc
-    recent_history.reverse()
+    session_manager = app_state.session_manager_firebase
+    multiplexer = app_state.pubsub_multiplexer
 
-    from langchain.schema import HumanMessage, AIMessage
+    # --- Ownership check ---
+    # A new session ID is reserved for its creator; any other session must
+    # already belong to the user
+    if isNewSession:
+        owns_session = await session_manager.reserve_new_session(
+            chat_session_id, user_id
+        )
+    else:
+        owns_session = (
+            await session_manager.get_session_owner(chat_session_id) == user_id
+        )
+    if not owns_session:
+        logging.error(
+            f"Unauthorized: session {chat_session_id} is not owned by {user_id}"
+        )
+        return status.HTTP_404_NOT_FOUND, {"error": "Session not found"}
 
-    langchain_history = []
-    for entry in recent_history:
-        role = entry.get("role")
-        content = entry.get("content", "")
-        if role == "human":
-            langchain_history.append(HumanMessage(content=content))
-        elif role == "ai":
-            langchain_history.append(AIMessage(content=content))
+    # Events of this turn are recorded under its ID so the stream can replay them
+    turn_id = new_turn_id()
 
-    # --- Query Refinement ---
-    refined_query = await refine_user_query(
-        chat_history=langchain_history,
-        query=user_message,
-        logger=logging,
+    # --- Duplicate submissions attach to the turn already running ---
+    turn_key, turn_key_ttl = idempotency_key(
+        user_id,
+        chat_session_id,
+        user_message,
+        message_request.idempotencyKey or client_key,
     )
+    claim = claim_turn(redis_instance, turn_key, chat_session_id, turn_id)
+    if isNewSession:
+        # The owner is recorded on the document before the turn stores
+        # anything, so a failed write fails the request instead of leaving
+        # messages in a session nobody owns
+        created, existing_turn = await asyncio.gather(
+            session_manager.create_session(
+                chat_session_id, user_id, pdf_id, initial_title=NEW_SESSION_TITLE
+            ),
+            claim,
+            return_exceptions=True,
+        )
+        if isinstance(existing_turn, BaseException):
+            raise existing_turn
+        if created is not True:
+            if existing_turn is None:
+                # Release the claim so a retry can start the turn
+                await redis_instance.delete(turn_key)
+            if isinstance(created, BaseException):
+                logging.error(
+                    f"❌ Failed to create session {chat_session_id}: {created}"
+                )
+                raise HTTPException(
+                    status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                    detail="Internal Server Error: Could not create the session",
+                )
+            logging.error(
+                f"Unauthorized: session {chat_session_id} was claimed by another user"
+            )
+            return status.HTTP_404_NOT_FOUND, {"error": "Session not found"}
+    else:
+        existing_turn = await claim
+    if existing_turn:
+        if existing_turn["chat_session_id"] != chat_session_id:
+            return status.HTTP_409_CONFLICT, {
+                "error": "Idempotency key was used for another session"
+            }
+        logging.info(
+            f"🔁 Duplicate message for session {chat_session_id}, "
+            f"attaching to turn {existing_turn['turn_id']}"
+        )
+        return status.HTTP_200_OK, {
+            "status": "Duplicate request attached to the existing turn",
+            "turn_id": existing_turn["turn_id"],
+            "duplicate": True,
+        }
 
-    # --- Store Original User Message ---
-    await session_manager.add_message(
-        chat_session_id, user_id, pdf_id, "human", user_message
-    )
+    # --- Title Generation (off the critical path) ---
+    if isNewSession:
+        asyncio.create_task(
+            title_new_session(
+                session_manager,
+                redis_instance,
+                chat_session_id,
+                user_message,
+                turn_id,
+                multiplexer,
+            )
+        )
 
-    # --- Prepare History for Chain ---
-    langchain_history_for_chain = langchain_history + [
-        HumanMessage(content=user_message)
-    ]
-
-    # --- Create Main Retrieval Chain ---
-    retrieval_chain = create_chain(
-        chat_history=langchain_history_for_chain,
-        user_id=user_id,
-        pdf_id=pdf_id,
-        preferred_model=model,
-        mode=retrieval_method,
-        isNewSession=isNewSession,
+    # --- Background Task: Prepare, Stream & Store AI Response ---
+    asyncio.create_task(
+        process_chat_turn(
+            session_manager,
+            redis_instance,
+            chat_session_id,
+            user_id,
+            pdf_id,
+            user_message,
+            model,
+            retrieval_method,
+            isNewSession,
+            turn_id,
+            multiplexer,
+            turn_key,
+            turn_key_ttl,
+        )
     )
 
-    # --- Background Task: Stream & Store AI Response ---
-    async def publish_response():
-        BATCH_SIZE = 5
-        MAX_DELAY = 0.1
-        chunk_buffer = []
-        all_processed = []
-        original_chunks = []
-        last_send = time.time()
-        generated = False
+    # --- Initial Response ---
+    response_payload = {"status": "Message processing started", "turn_id": turn_id}
+    if isNewSession:
+        response_payload["status"] = (
+            "New chat session created, title generation started"
+        )
+    return status.HTTP_200_OK, response_payload
 
-        try:
-            async for orig_chunk, proc_item in stream_with_indentation_fix(
-                retrieval_chain.astream(refined_query)
-            ):
-                # Extract original text
-                if isinstance(orig_chunk, dict):
-                    text = (
-                        orig_chunk.get("answer")
-                        or orig_chunk.get("content")
-                        or orig_chunk.get("text")
-                    )
-                elif hasattr(orig_chunk, "content"):
-                    text = orig_chunk.content
-                else:
-                    text = orig_chunk if isinstance(orig_chunk, str) else None
-
-                if text:
-                    original_chunks.append(text)
-
-                if isinstance(proc_item, str):
-                    generated = True
-                    chunk_buffer.append(proc_item)
-                    all_processed.append(proc_item)
-
-                    if (
-                        len(chunk_buffer) >= BATCH_SIZE
-                        or (time.time() - last_send) > MAX_DELAY
-                    ):
-                        await redis_instance.publish(
-                            f"chat:{chat_session_id}",
-                            json.dumps(
-                                {
-                                    "type": "chunk",
-                                    "content": chunk_buffer,
-                                    "timestamp": time.time(),
-                                }
-                            ),
-                        )
-                        chunk_buffer = []
-                        last_send = time.time()
-                # ignore non-str items for now
-
-        except Exception as stream_err:
-            logging.exception(
-                f"❌ Error streaming response for session {chat_session_id}: {stream_err}"
-            )
-            # Notify frontend of error
-            try:
-                await redis_instance.publish(
-                    f"chat:{chat_session_id}",
-                    json.dumps(
-                        {
-                            "type": "error",
-                            "content": f"Error processing response: {stream_err}",
-                            "timestamp": time.time(),
-                        }
-                    ),
-                )
-            except Exception as pub_err:
-                logging.error(f"❌ Failed publishing error event: {pub_err}")
-            return  # abort further processing
 
-        # Flush remaining chunks
-        if chunk_buffer:
-            await redis_instance.publish(
-                f"chat:{chat_session_id}",
-                json.dumps(
-                    {
-                        "type": "chunk",
-                        "content": chunk_buffer,
-                        "timestamp": time.time(),
-                    }
-                ),
-            )
+@router.post("/chat_send")
+@limiter.limit("30/minute")
+async def chat_send(
+    request: Request,
+    message_request: MessageRequest,
+    user_id_from_token: str = Depends(get_current_user),  # Authenticated user ID
+):
+    """
+    Handles sending a chat message and returns immediately; the response is
+    streamed via /chat_stream.
+    """
+    status_code, content = await start_chat_turn(
+        request.app.state,
+        message_request,
+        user_id_from_token,
+        request.headers.get("idempotency-key"),
+    )
+    return JSONResponse(status_code=status_code, content=content)
+
 
-        # Signal completion
-        await redis_instance.publish(
-            f"chat:{chat_session_id}",
-            json.dumps({"type": "complete", "timestamp": time.time()}),
+@router.get("/sessions/{chat_session_id}/messages")
+async def get_session_messages(
+    request: Request,
+    chat_session_id: str,
+    before: Optional[int] = Query(None, ge=1),
+    limit: int = Query(HISTORY_PAGE_DEFAULT, ge=1, le=HISTORY_PAGE_MAX),
+    user_id: str = Depends(get_current_user),
+):
+    """
+    Returns one page of a session's messages, oldest first. `before` is the
+    `next_cursor` of the previous page; omit it for the latest messages.
+    Pages carry an ETag, so an unchanged page is answered with 304 before any
+    messages are read or the history cache is warmed.
+    """
+    session_manager = request.app.state.session_manager_firebase
+    if session_manager is None:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail="Internal Server Error: Session storage unavailable",
         )
 
-        # Store full AI response
-        if generated:
-            full = "".join(original_chunks)
-            await session_manager.add_message(
-                chat_session_id, user_id, pdf_id, "ai", full
-            )
-            logging.info(f"Full AI response stored for session {chat_session_id}")
-        else:
-            logging.warning(f"No AI content generated for session {chat_session_id}")
-
-    # Kick off streaming in background
-    asyncio.create_task(publish_response())
-
-    # --- Initial HTTP Response ---
-    response_payload = {"status": "Message processing started"}
-    if isNewSession and new_title:
-        response_payload.update(
-            {
-                "status": "New chat session created, title generation started",
-                "new_title": new_title,
-            }
+    # Authorised against the owner on the session document, before anything
+    # is cached; unknown sessions are refused
+    state = await session_manager.get_session_state(chat_session_id)
+    if state["owner"] != user_id:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND, detail="Session not found"
         )
-    return JSONResponse(status_code=status.HTTP_200_OK, content=response_payload)
+
+    # A page is identified by its last sequence number and size; messages
+    # never change once written, so that is all the ETag needs
+    end_seq = state["seq"] if before is None else min(state["seq"], before - 1)
+    etag = f'W/"{end_seq}-{limit}"'
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    messages = await session_manager.get_message_page(chat_session_id, limit, before)
+    next_cursor = messages[0]["seq"] if messages and messages[0]["seq"] > 1 else None
+    return JSONResponse(
+        status_code=status.HTTP_200_OK,
+        content={
+            "messages": [
+                {k: v for k, v in message.items() if k != "tokens"}
+                for message in messages
+            ],
+            "next_cursor": next_cursor,
+        },
+        headers=headers,
+    )
+
+
+def render_sse_event(data: dict, all_chunks: List[str]) -> Tuple[List[str], bool]:
+    """Render one chat event as SSE frames; returns the frames and whether the stream ends."""
+    id_line = f"id: {data['id']}\n" if data.get("id") else ""
+    if data["type"] == "chunk":
+        # A coalesced batch stays one SSE event; turns recorded before
+        # coalescing carry a list of chunks
+        content = data["content"]
+        if isinstance(content, list):
+            content = "".join(content)
+        all_chunks.append(content)
+        sse_payload = {"type": "chunk", "content": content}
+        return [f"{id_line}data: {json.dumps(sse_payload)}\n\n"], False
+    if data["type"] in ("title", "sources", "error"):
+        return [f"{id_line}data: {json.dumps(data)}\n\n"], data["type"] == "error"
+    if data["type"] == "complete":
+        print(
+            f"Full AI Response (chat_stream - complete signal): {''.join(all_chunks)}"
+        )  # Print the full response on complete
+        return [f"{id_line}event: end\ndata: \n\n"], True
+    return [], False
+
+
+async def iter_session_events(
+    redis_instance,
+    queue: asyncio.Queue,
+    replay_turn: Optional[str] = None,
+    replayed_upto: str = "0-0",
+    idle_timeout: Optional[float] = None,
+):
+    """
+    Yields the recorded events of `replay_turn` after `replayed_upto`, then
+    the live events from a multiplexer queue, skipping live events that were
+    already replayed. Subscribe the queue before calling, so no event falls
+    between the two. Yields None after `idle_timeout` seconds without events
+    and passes STREAM_OVERFLOW through.
+    """
+    if replay_turn:
+        for data in await read_turn_events(redis_instance, replay_turn, replayed_upto):
+            replayed_upto = parse_event_id(data["id"])[1]
+            yield data
+
+    while True:
+        try:
+            data = await asyncio.wait_for(queue.get(), idle_timeout)
+        except asyncio.TimeoutError:
+            yield None
+            continue
+
+        if data is not STREAM_OVERFLOW:
+            # Live events that were already replayed are skipped
+            event_id = parse_event_id(data.get("id"))
+            if (
+                event_id
+                and event_id[0] == replay_turn
+                and entry_order(event_id[1]) <= entry_order(replayed_upto)
+            ):
+                continue
+        yield data
 
 
 @router.get("/chat_stream/{chat_session_id}")
-async def chat_stream(request: Request, chat_session_id: str):
+async def chat_stream(
+    request: Request, chat_session_id: str, turn_id: Optional[str] = None
+):
+    """
+    Streams chat events as SSE. With the `turn_id` returned by /chat_send the
+    turn is replayed from its start, and a reconnecting client resumes after
+    its Last-Event-ID; without either, only live events are sent.
+    """
+
     async def event_generator():
-        redis = await request.app.state.redis_instance
-        if not redis:
+        redis_instance = request.app.state.redis_instance
+        multiplexer = request.app.state.pubsub_multiplexer
+        if redis_instance is None:
             yield "event: error\ndata: Redis unavailable\n\n"
             return
 
-        pubsub = redis.pubsub()
+        resume = parse_event_id(request.headers.get("last-event-id"))
+        replay_turn, replayed_upto = resume or (turn_id, "0-0")
+
+        channel = f"chat:{chat_session_id}"
+        # Subscribe before replaying so no event falls between the two
+        queue = await multiplexer.subscribe(channel)
         all_chunks: List[str] = []
+        KEEP_ALIVE_INTERVAL = 15
         try:
-            await pubsub.subscribe(f"chat:{chat_session_id}")
-            last_activity = time.time()
-            KEEP_ALIVE_INTERVAL = 15
-
-            while True:
-                try:
-                    message = await pubsub.get_message(
-                        ignore_subscribe_messages=True,
-                        timeout=0.05,
-                    )
-
-                    if message:
-                        last_activity = time.time()
-                        data = json.loads(message["data"])
-
-                        if data["type"] == "chunk":
-                            # Send each chunk from the batch as a separate JSON message (FIXED)
-                            for chunk_content in data["content"]:
-                                all_chunks.append(chunk_content)  # Append every chunk
-                                # Create the JSON payload expected by the frontend
-                                sse_payload = {
-                                    "type": "chunk",
-                                    "content": chunk_content,  # Send one piece of content at a time
-                                }
-                                # Yield the JSON string as the SSE data field
-                                # Use json.dumps to convert the dict to a JSON string
-                                yield f"data: {json.dumps(sse_payload)}\n\n"
-                        elif data["type"] == "complete":
-                            print(
-                                f"Full AI Response (chat_stream - complete signal): {''.join(all_chunks)}"
-                            )  # Print the full response on complete
-                            yield "event: end\ndata: \n\n"
-                            break
-
-                    # Send keep-alive only if inactive (MODIFIED)
-                    if (time.time() - last_activity) > KEEP_ALIVE_INTERVAL:
-                        yield ":keep-alive\n\n"
-                        last_activity = time.time()
-
-                except asyncio.TimeoutError:
+            async for data in iter_session_events(
+                redis_instance, queue, replay_turn, replayed_upto, KEEP_ALIVE_INTERVAL
+            ):
+                if data is None:
+                    # Send keep-alive only if inactive
+                    yield ":keep-alive\n\n"
                     continue
-                except Exception as e:
-                    logging.error(f"Stream error: {e}")
+
+                if data is STREAM_OVERFLOW:
+                    SSE_SUBSCRIBERS_DROPPED.inc()
+                    yield f"data: {json.dumps({'type': 'error', 'content': 'Stream fell behind, please retry'})}\n\n"
+                    break
+
+                frames, done = render_sse_event(data, all_chunks)
+                for frame in frames:
+                    yield frame
+                if done:
                     break
 
         except asyncio.CancelledError:
             logging.info(f"Client disconnected from {chat_session_id}")
+        except Exception as e:
+            logging.error(f"Stream error: {e}")
         finally:
             try:
-                await pubsub.unsubscribe(f"chat:{chat_session_id}")
-                await pubsub.close()
+                await multiplexer.unsubscribe(channel, queue)
             except Exception as e:
                 logging.error(f"Cleanup error: {e}")
 
@@ -0,0 +1,63 @@
+import json
+import os
+
+import orjson
+import zstandard
+
+# Serialised session records start with a version byte naming their format.
+# Records written before the codec existed are compact JSON text, which always
+# starts with "{", so readers decode old and new records alike and the write
+# format can be switched without downtime. Set SESSION_CODEC=json to keep
+# writing the legacy format until every replica can read the binary ones.
+CODEC_VERSION_ORJSON = 1
+CODEC_VERSION_ORJSON_ZSTD = 2
+
+SESSION_CODEC = os.getenv("SESSION_CODEC", "orjson")
+# Records at least this large are compressed with zstd when it saves space
+SESSION_COMPRESS_MIN_BYTES = int(os.getenv("SESSION_COMPRESS_MIN_BYTES", "1024"))
+SESSION_ZSTD_LEVEL = int(os.getenv("SESSION_ZSTD_LEVEL", "3"))
+
+
+class SessionCodec:
+    """
+    Encodes session records for Redis: orjson, with zstd for large records,
+    behind a one-byte format version. Decoding accepts every known version.
+    """
+
+    def __init__(
+        self,
+        name: str = SESSION_CODEC,
+        compress_min_bytes: int = SESSION_COMPRESS_MIN_BYTES,
+        zstd_level: int = SESSION_ZSTD_LEVEL,
+    ):
+        if name not in ("orjson", "json"):
+            raise ValueError(f"Unknown session codec: {name}")
+        self.name = name
+        self.compress_min_bytes = compress_min_bytes
+        self.compressor = zstandard.ZstdCompressor(level=zstd_level)
+        self.decompressor = zstandard.ZstdDecompressor()
+
+    def encode(self, obj: dict) -> bytes:
+        if self.name == "json":
+            return json.dumps(obj, separators=(",", ":")).encode()
+
+        payload = orjson.dumps(obj)
+        if len(payload) >= self.compress_min_bytes:
+            compressed = self.compressor.compress(payload)
+            if len(compressed) < len(payload):
+                return bytes([CODEC_VERSION_ORJSON_ZSTD]) + compressed
+        return bytes([CODEC_VERSION_ORJSON]) + payload
+
+    def decode(self, data) -> dict:
+        if isinstance(data, str):
+            data = data.encode()
+        version = data[0]
+        if version == CODEC_VERSION_ORJSON:
+            return orjson.loads(data[1:])
+        if version == CODEC_VERSION_ORJSON_ZSTD:
+            return orjson.loads(self.decompressor.decompress(data[1:]))
+        # No version byte: legacy JSON text
+        return orjson.loads(data)
+
+
+session_codec = SessionCodec()
@@ -1,17 +1,126 @@
 import redis.asyncio as redis
+from redis.exceptions import WatchError
 import os
 import json
 import asyncio
 import logging
 import time
+import zlib
+from typing import Optional
 from google.cloud import firestore
+from .token_budget import count_tokens
+from .metrics import timed
+from .firestore_dal import FirestoreDAL
+from .flush_coordinator import dirty_stream_key
+from .session_codec import session_codec
+
+
+# Number of lock stripes; sessions hashing to different stripes never wait on each other
+SESSION_LOCK_STRIPES = 256
+
+# The recent history of an active session is cached in Redis as an append-only
+# list of compact records, where the record at index i has sequence number
+# base_seq+i+1. Session metadata lives in a hash next to it: pdfId,
+# last_activity, seq (last assigned), flushed_seq (last persisted to
+# Firestore), base_seq and warm (set once the list is populated).
+MESSAGES_KEY = "session_messages:{}"
+META_KEY = "session_meta:{}"
+SUMMARY_KEY = "session_summary:{}"
+LAST_FLUSH_KEY = "session_last_flush:{}"
+LEGACY_SESSION_KEY = "session:{}"
+
+# Owner of a session as recorded on its Firestore document. Request data never
+# sets it, except to reserve an ID no document claims yet for its creator
+# until the document is created.
+OWNER_KEY = "session_owner:{}"
+NEW_SESSION_CLAIM_TTL_SECONDS = 300
+
+# Key lifecycle: every per-session key expires a day after the session was last
+# used. The expiry is set by the write that creates a key and pushed out again
+# by every read or append, so idle sessions leave Redis without a sweeper.
+SESSION_CACHE_TTL_SECONDS = 24 * 3600
+SESSION_KEY_FAMILIES = (MESSAGES_KEY, META_KEY, SUMMARY_KEY, LAST_FLUSH_KEY)
+
+# Messages loaded from Firestore when the cache is warmed
+HISTORY_CACHE_WINDOW = 200
+
+# Every append also adds the session ID to its shard's dirty stream; the flush
+# worker owning that shard consumes it to persist changed sessions.
+# active_sessions remains the set of sessions with unflushed messages and is
+# used to reconcile missed events.
+DIRTY_STREAM_MAXLEN = 100_000
+
+# Compact record field names <-> stored message field names
+_PACKED_FIELDS = {
+    "r": "role",
+    "c": "content",
+    "t": "timestamp",
+    "p": "pdfId",
+    "n": "tokens",
+    "s": "seq",
+    "x": "truncated",
+}
+_UNPACKED_FIELDS = {v: k for k, v in _PACKED_FIELDS.items()}
+
+
+def pack_message(message: dict) -> bytes:
+    """Encode a message as a compact record for the Redis list."""
+    return session_codec.encode(
+        {_UNPACKED_FIELDS.get(k, k): v for k, v in message.items()}
+    )
+
+
+def unpack_message(record: bytes) -> dict:
+    """Decode a compact Redis list record back into a message dict."""
+    return {_PACKED_FIELDS.get(k, k): v for k, v in session_codec.decode(record).items()}
+
+
+def expire_session_keys(pipe, chat_session_id: str):
+    """Queue expiry refreshes for all keys of a session on a pipeline."""
+    for key in SESSION_KEY_FAMILIES:
+        pipe.expire(key.format(chat_session_id), SESSION_CACHE_TTL_SECONDS)
+
+
+async def migrate_legacy_session(redis_instance, chat_session_id: str):
+    """
+    Moves history still stored in the legacy `session:{id}` JSON blob into the
+    message list and metadata hash. Legacy messages are older than anything in
+    the list, so they are pushed to its head.
+    """
+    legacy_key = LEGACY_SESSION_KEY.format(chat_session_id)
+    legacy_data = await redis_instance.get(legacy_key)
+    if not legacy_data:
+        return
+
+    session_data = json.loads(legacy_data)
+    messages = session_data.get("chat_history", [])
+    meta_key = META_KEY.format(chat_session_id)
+    async with redis_instance.pipeline(transaction=True) as pipe:
+        if messages:
+            pipe.lpush(
+                MESSAGES_KEY.format(chat_session_id),
+                *[pack_message(m) for m in reversed(messages)],
+            )
+        pipe.hsetnx(meta_key, "userId", session_data.get("userId", ""))
+        pipe.hsetnx(meta_key, "pdfId", session_data.get("pdfId", ""))
+        pipe.delete(legacy_key)
+        await pipe.execute()
+    logging.info(f"Migrated legacy Redis session {chat_session_id} to list storage")
 
 
 class SessionManager:
-    def __init__(self, db=None, redis_instance=None):
-        self.lock = asyncio.Lock()
+    def __init__(self, dal: FirestoreDAL, redis_instance=None, binary_redis=None):
+        self.locks = [asyncio.Lock() for _ in range(SESSION_LOCK_STRIPES)]
         self.redis = redis_instance
-        self.db = db or firestore.Client()
+        # Message lists and metadata hashes hold codec-encoded binary records,
+        # so they are accessed through a connection that does not decode replies
+        self.binary_redis = binary_redis
+        self.dal = dal
+
+    def lock_for(self, chat_session_id: str) -> asyncio.Lock:
+        """Return the lock stripe guarding a session's read-modify-write cycle."""
+        stripe = zlib.crc32(chat_session_id.encode()) % SESSION_LOCK_STRIPES
+        return self.locks[stripe]
 
     async def init_redis(self):
         """Initialize Redis or crash if it fails."""
@@ -27,112 +136,354 @@ class SessionManager:
                 logging.critical(f"❌ CRITICAL: Failed to initialize Redis: {e}")
                 raise RuntimeError("🚨 Cannot connect to Redis. Shutting down.")
 
+    async def ensure_cached(self, chat_session_id: str):
+        """
+        Warm the Redis cache with the latest HISTORY_CACHE_WINDOW messages from
+        the Firestore messages subcollection if it is not there yet, migrating a
+        legacy `chat_history` array on the way. Pending messages written before
+        the cache existed are kept after the Firestore window and stay unflushed.
+        """
+        meta_key = META_KEY.format(chat_session_id)
+        messages_key = MESSAGES_KEY.format(chat_session_id)
+        if await self.binary_redis.hget(meta_key, "warm"):
+            return
+
+        # One warm-up per session and process; other replicas are fenced by WATCH
+        async with self.lock_for(chat_session_id):
+            if await self.binary_redis.hget(meta_key, "warm"):
+                return
+
+            await migrate_legacy_session(self.binary_redis, chat_session_id)
+
+            with timed("firestore_get_history"):
+                session_dict = await self.dal.get_session(chat_session_id) or {}
+                if "chat_history" in session_dict:
+                    session_dict = await self.dal.migrate_session_messages(
+                        chat_session_id, session_dict
+                    )
+                firestore_window = await self.dal.get_messages(
+                    chat_session_id, HISTORY_CACHE_WINDOW
+                )
+
+            # Sequence number of the last message persisted in Firestore
+            flushed_seq = max(
+                int(session_dict.get("message_count") or 0),
+                firestore_window[-1]["seq"] if firestore_window else 0,
+            )
+            base_seq = firestore_window[0]["seq"] - 1 if firestore_window else flushed_seq
+
+            async with self.binary_redis.pipeline(transaction=True) as pipe:
+                try:
+                    await pipe.watch(meta_key, messages_key)
+                    if await pipe.hget(meta_key, "warm"):
+                        return
+                    records = await pipe.lrange(messages_key, 0, -1)
+                    # Records past the flushed sequence number are pending.
+                    # Legacy records carry no sequence number; the legacy blob
+                    # held the whole history from the first message and
+                    # migrate_session_messages numbers the Firestore array by
+                    # position, so a legacy record's position is its number.
+                    # Sessions whose legacy flush already dropped a same-second
+                    # message from Firestore cannot be realigned from this data.
+                    pending = []
+                    for index, msg in enumerate(map(unpack_message, records)):
+                        if msg.setdefault("seq", index + 1) > flushed_seq:
+                            pending.append(msg)
+
+                    for seq, msg in enumerate(pending, start=flushed_seq + 1):
+                        msg["seq"] = seq
+                    history = firestore_window + pending
+
+                    pipe.multi()
+                    pipe.delete(messages_key)
+                    if history:
+                        pipe.rpush(messages_key, *[pack_message(m) for m in history])
+                    pipe.hset(
+                        meta_key,
+                        mapping={
+                            "warm": 1,
+                            "base_seq": base_seq,
+                            "seq": flushed_seq + len(pending),
+                            "flushed_seq": flushed_seq,
+                        },
+                    )
+                    expire_session_keys(pipe, chat_session_id)
+                    await pipe.execute()
+                    logging.info(
+                        f"Warmed history cache for session {chat_session_id} "
+                        f"({len(history)} messages)"
+                    )
+                except WatchError:
+                    # Another replica warmed or appended concurrently; its state wins
+                    logging.info(f"History cache for {chat_session_id} warmed elsewhere")
+
     async def add_message(
-        self, chat_session_id: str, user_id: str, pdf_id: str, role: str, message: str
+        self,
+        chat_session_id: str,
+        user_id: str,
+        pdf_id: str,
+        role: str,
+        message: str,
+        truncated: bool = False,
     ):
-        """Add a structured message to session history and update Redis keys."""
-        async with self.lock:
-            session_key = f"session:{chat_session_id}"
-            count_key = f"session_count:{chat_session_id}"
-            timestamp_key = f"session_last_activity:{chat_session_id}"
-
-            session_data = await self.redis.get(session_key) or json.dumps(
-                {"userId": user_id, "pdfId": pdf_id, "chat_history": []}
-            )
-            session_data = json.loads(session_data)
+        """
+        Append a structured message to the cached history with the next sequence
+        number (write-through; the flush task persists it to Firestore). An
+        optimistic WATCH/MULTI transaction keeps list order and sequence numbers
+        consistent across replicas without a process lock. `truncated` marks an
+        answer whose generation was cancelled.
+        """
+        logging.info(
+            f"Storing session: {chat_session_id}, user: {user_id}, pdf: {pdf_id}"
+        )
+        meta_key = META_KEY.format(chat_session_id)
+        messages_key = MESSAGES_KEY.format(chat_session_id)
 
-            # Ensure pdfId is always stored
-            session_data["pdfId"] = pdf_id
+        now = int(time.time())
+        new_message = {
+            "role": role,
+            "content": message,
+            "timestamp": now,
+            "pdfId": pdf_id,
+            "tokens": count_tokens(message),
+        }
+        if truncated:
+            new_message["truncated"] = True
 
-            logging.info(
-                f"Storing session: {chat_session_id}, user: {user_id}, pdf: {pdf_id}"
-            )
+        while True:
+            await self.ensure_cached(chat_session_id)
+            async with self.binary_redis.pipeline(transaction=True) as pipe:
+                try:
+                    await pipe.watch(meta_key)
+                    warm, seq = await pipe.hmget(meta_key, "warm", "seq")
+                    if not warm:
+                        continue  # Cache expired in between; warm it again
+                    new_message["seq"] = int(seq or 0) + 1
 
-            new_message = {
-                "role": role,
-                "content": message,
-                "timestamp": int(time.time()),
-                "pdfId": pdf_id,
-            }
-            session_data["chat_history"].append(new_message)
-
-            # Save back to Redis
-            async with self.redis.pipeline() as pipe:
-                pipe.set(session_key, json.dumps(session_data))
-                pipe.incr(count_key)
-                pipe.set(timestamp_key, int(time.time()))
-                pipe.sadd("active_sessions", chat_session_id)
-                await pipe.execute()
+                    pipe.multi()
+                    pipe.rpush(messages_key, pack_message(new_message))
+                    # Ensure pdfId is always stored; the owner is never
+                    # taken from a message
+                    pipe.hset(
+                        meta_key,
+                        mapping={
+                            "pdfId": pdf_id,
+                            "last_activity": now,
+                            "seq": new_message["seq"],
+                        },
+                    )
+                    expire_session_keys(pipe, chat_session_id)
+                    pipe.sadd("active_sessions", chat_session_id)
+                    pipe.xadd(
+                        dirty_stream_key(chat_session_id),
+                        {"sid": chat_session_id},
+                        maxlen=DIRTY_STREAM_MAXLEN,
+                        approximate=True,
+                    )
+                    await pipe.execute()
+                    return new_message
+                except WatchError:
+                    continue  # Concurrent append took this sequence number; retry
+
+    async def get_recent_messages(
+        self, chat_session_id: str, count: int = HISTORY_CACHE_WINDOW
+    ):
+        """
+        Return up to `count` of the most recent messages of the session, oldest
+        first, from Redis. Firestore is only read when the cache is cold, and
+        the read costs O(count) however long the cached list has grown.
+        """
+        await self.ensure_cached(chat_session_id)
+        async with self.binary_redis.pipeline(transaction=False) as pipe:
+            pipe.lrange(MESSAGES_KEY.format(chat_session_id), -count, -1)
+            expire_session_keys(pipe, chat_session_id)
+            records = (await pipe.execute())[0]
+        return [unpack_message(record) for record in records]
 
-    async def get_history(self, chat_session_id: str):
-        """Retrieve chat history by comparing Firestore and Redis versions, merging only newer messages."""
-        async with self.lock:
-            session_key = f"session:{chat_session_id}"
+    async def get_session_state(self, chat_session_id: str) -> dict:
+        """
+        Return the owner and last sequence number of a session without warming
+        the history cache. The sequence number comes from the metadata while
+        the cache is warm, and otherwise from message_count on the session
+        document; the document is read at most once for both.
+        """
+        owner = await self.redis.get(OWNER_KEY.format(chat_session_id))
+        warm, seq = await self.binary_redis.hmget(
+            META_KEY.format(chat_session_id), "warm", "seq"
+        )
+        if owner and warm:
+            return {"owner": owner, "seq": int(seq or 0)}
 
-            # Fetch from Firestore
-            session_ref = self.db.collection("sessions").document(chat_session_id)
-            session_doc = session_ref.get()
+        session_dict = await self.dal.get_session(chat_session_id) or {}
+        if not owner:
+            owner = await self._cache_owner(chat_session_id, session_dict)
+        if not warm:
+            # Nothing is pending while the cache is cold
+            seq = session_dict.get("message_count")
+        return {"owner": owner, "seq": int(seq or 0)}
 
-            firestore_history = (
-                session_doc.to_dict().get("chat_history", [])
-                if session_doc.exists
-                else []
-            )
-            last_firestore_timestamp = (
-                firestore_history[-1]["timestamp"] if firestore_history else 0
+    async def get_message_page(
+        self, chat_session_id: str, limit: int, before_seq: Optional[int] = None
+    ):
+        """
+        Return up to `limit` messages with a sequence number below `before_seq`
+        (or the latest ones), oldest first. The part of the page inside the
+        cached window comes from Redis; only older messages are read from the
+        Firestore subcollection, so a page costs O(limit) either way.
+        """
+        await self.ensure_cached(chat_session_id)
+        base_seq, seq = await self.binary_redis.hmget(
+            META_KEY.format(chat_session_id), "base_seq", "seq"
+        )
+        base_seq, seq = int(base_seq or 0), int(seq or 0)
+        end_seq = seq if before_seq is None else min(seq, before_seq - 1)
+        start_seq = max(end_seq - limit + 1, 1)
+
+        cached = []
+        if end_seq > base_seq:
+            # List index i holds sequence number base_seq+i+1
+            records = await self.binary_redis.lrange(
+                MESSAGES_KEY.format(chat_session_id),
+                max(start_seq, base_seq + 1) - base_seq - 1,
+                end_seq - base_seq - 1,
             )
+            cached = [unpack_message(record) for record in records]
 
-            # Fetch from Redis
-            redis_data = await self.redis.get(session_key)
-            if redis_data:
-                redis_data = json.loads(redis_data)
-                redis_history = redis_data.get("chat_history", [])
+        older = []
+        older_end_seq = min(end_seq, base_seq)
+        if start_seq <= older_end_seq:
+            with timed("firestore_get_history"):
+                older = await self.dal.get_messages(
+                    chat_session_id,
+                    older_end_seq - start_seq + 1,
+                    before_seq=older_end_seq + 1,
+                )
+        return older + cached
 
-                # Merge only newer messages
-                new_messages = [
-                    msg
-                    for msg in redis_history
-                    if msg["timestamp"] > last_firestore_timestamp
-                ]
+    async def get_session_owner(self, chat_session_id: str) -> Optional[str]:
+        """
+        Return the user ID on the session's Firestore document (cached in
+        Redis), or None if there is no document or it names no owner. Does not
+        warm the history cache, so probing unknown IDs leaves nothing behind.
+        """
+        owner_key = OWNER_KEY.format(chat_session_id)
+        owner = await self.redis.get(owner_key)
+        if owner:
+            return owner
 
-                if new_messages:
-                    logging.info(f"Merging new messages for session: {chat_session_id}")
-                    return firestore_history + new_messages
+        session_dict = await self.dal.get_session(chat_session_id) or {}
+        return await self._cache_owner(chat_session_id, session_dict)
 
-            logging.info(f"Returning Firestore history for session: {chat_session_id}")
-            return firestore_history
+    async def _cache_owner(
+        self, chat_session_id: str, session_dict: dict
+    ) -> Optional[str]:
+        owner = session_dict.get("userId")
+        if not owner:
+            return None
+        await self.redis.set(
+            OWNER_KEY.format(chat_session_id), owner, ex=SESSION_CACHE_TTL_SECONDS
+        )
+        return owner
+
+    async def reserve_new_session(self, chat_session_id: str, user_id: str) -> bool:
+        """
+        Reserve a session ID for the user creating it, until create_session
+        records the owner on the document. Returns whether the user owns the
+        session; an ID already owned by someone else is refused.
+        """
+        owner = await self.get_session_owner(chat_session_id)
+        if owner:
+            return owner == user_id
+        owner_key = OWNER_KEY.format(chat_session_id)
+        await self.redis.set(
+            owner_key, user_id, nx=True, ex=NEW_SESSION_CLAIM_TTL_SECONDS
+        )
+        return await self.redis.get(owner_key) == user_id
+
+    async def get_summary(self, chat_session_id: str) -> dict:
+        """Return the rolling summary of the session and the seq of the last message it covers."""
+        summary_key = SUMMARY_KEY.format(chat_session_id)
+        cached = await self.redis.get(summary_key)
+        if cached:
+            return json.loads(cached)
+
+        session_dict = await self.dal.get_session(chat_session_id) or {}
+        summary = {
+            "summary": session_dict.get("summary", ""),
+            "summary_upto": session_dict.get("summary_upto", 0),
+        }
+        await self.redis.set(
+            summary_key, json.dumps(summary), ex=SESSION_CACHE_TTL_SECONDS
+        )
+        return summary
+
+    async def set_summary(self, chat_session_id: str, summary: str, summary_upto: int):
+        """Store the rolling summary in Redis and on the Firestore session document."""
+        await self.redis.set(
+            SUMMARY_KEY.format(chat_session_id),
+            json.dumps({"summary": summary, "summary_upto": summary_upto}),
+            ex=SESSION_CACHE_TTL_SECONDS,
+        )
+        await self.dal.set_session(
+            chat_session_id, {"summary": summary, "summary_upto": summary_upto}
+        )
+        logging.info(
+            f"Updated summary for session {chat_session_id} (covers up to seq {summary_upto})"
+        )
 
     async def clear_session(self, chat_session_id: str):
         """Clear session history in Redis and Firestore."""
-        async with self.lock:
-            session_key = f"session:{chat_session_id}"
-            await self.redis.delete(session_key)
+        async with self.lock_for(chat_session_id):
+            async with self.redis.pipeline(transaction=True) as pipe:
+                pipe.delete(
+                    MESSAGES_KEY.format(chat_session_id),
+                    META_KEY.format(chat_session_id),
+                    SUMMARY_KEY.format(chat_session_id),
+                    LAST_FLUSH_KEY.format(chat_session_id),
+                    LEGACY_SESSION_KEY.format(chat_session_id),
+                    OWNER_KEY.format(chat_session_id),
+                )
+                pipe.srem("active_sessions", chat_session_id)
+                await pipe.execute()
 
-            self.db.collection("sessions").document(chat_session_id).delete()
+            await self.dal.delete_session(chat_session_id)
             logging.info(f"Cleared session: {chat_session_id}")
 
     async def create_session(
         self, chat_session_id: str, user_id: str, pdf_id: str, initial_title: str
-    ):
-        """Create a new session with initial title"""
-        session_ref = self.db.collection("sessions").document(chat_session_id)
-        session_ref.set(
+    ) -> bool:
+        """Create a new session, recording its owner and initial title in a single write.
+
+        Merges into the document, since the background flush may already
+        have written the first messages of the session. The owner is only
+        recorded if the document does not name one yet; returns False, and
+        writes nothing, if another user owns it. A document the user already
+        owns is left as it is, so a retried request keeps its title.
+        """
+        created = await self.dal.create_session(
+            chat_session_id,
             {
                 "userId": user_id,
                 "latest_pdfId": pdf_id,
                 "title": initial_title,
                 "created_at": firestore.SERVER_TIMESTAMP,
                 "updated_at": firestore.SERVER_TIMESTAMP,
-                "chat_history": [],
-            }
+            },
         )
+        owner_key = OWNER_KEY.format(chat_session_id)
+        if created:
+            await self.redis.set(owner_key, user_id, ex=SESSION_CACHE_TTL_SECONDS)
+        elif await self.redis.get(owner_key) == user_id:
+            # Drop the reservation; the document's owner is read on next use
+            await self.redis.delete(owner_key)
+        return created
 
     async def update_session_title(self, chat_session_id: str, new_title: str):
         """Update session title in Firestore with guaranteed valid title"""
         try:
-            session_ref = self.db.collection("sessions").document(chat_session_id)
-            session_ref.update(
-                {"title": new_title, "updated_at": firestore.SERVER_TIMESTAMP}
+            await self.dal.update_session(
+                chat_session_id,
+                {"title": new_title, "updated_at": firestore.SERVER_TIMESTAMP},
             )
             logging.info(f"Updated title for session {chat_session_id} to: {new_title}")
         except Exception as e:
@@ -1,97 +1,103 @@
-async def stream_with_indentation_fix(raw_chunk_iterator):
-    """
-    Async generator that processes chunks from a raw stream.
-    Removes leading whitespace from string content at the start of lines
-    that immediately follow a newline, unless it appears to be within a fenced code block.
-    Yields tuples: (original_chunk, processed_string_content_or_original_non_string_chunk).
+from typing import Optional
 
-    Args:
-        raw_chunk_iterator: An async iterator yielding chunks from an LLM stream
-                            (e.g., retrieval_chain.astream()).
+FENCE_MARKERS = ("```", "~~~")
 
-    Yields:
-        tuple: A tuple containing (original_chunk, processed_item).
-               processed_item is the string content after potential stripping,
-               or the original_chunk if it wasn't string content.
-    """
-    last_char_was_newline = (
-        True  # State: Did the previous character processed end a line?
-    )
-    # We could add state here to track if we are inside a fenced code block (```)
-    # but reliably detecting that across arbitrary chunks is very complex.
-    # The current logic focuses on removing indentation from lines that *start*
-    # with whitespace immediately after a newline, which is the common case
-    # for unintended paragraph/list indentation. This might still strip
-    # indentation from 'indented code blocks' (4+ spaces) if they appear
-    # at the start of a chunk after a newline.
 
-    async for original_chunk in raw_chunk_iterator:
-        content_to_process = None
-        # Extract string content if available from various chunk structures
-        if isinstance(original_chunk, dict):
-            content_to_process = (
-                original_chunk.get("answer")
-                or original_chunk.get("content")
-                or original_chunk.get("text")
-            )
-        elif hasattr(original_chunk, "content"):
-            content_to_process = original_chunk.content
-        elif isinstance(original_chunk, str):  # Handle raw string chunks
-            content_to_process = original_chunk
+def extract_chunk_text(chunk) -> Optional[str]:
+    """Return the text carried by an LLM stream chunk, or None for non-text chunks."""
+    if isinstance(chunk, dict):
+        text = chunk.get("answer") or chunk.get("content") or chunk.get("text")
+    elif hasattr(chunk, "content"):
+        text = chunk.content
+    else:
+        text = chunk
+    return text if isinstance(text, str) else None
 
-        if content_to_process is not None and isinstance(content_to_process, str):
-            processed_content_chunk = ""
-            remaining_content = content_to_process
 
-            # Process the chunk line by line
-            while remaining_content:
-                newline_index = remaining_content.find("\n")
+class IndentationFixer:
+    """
+    Streaming post-processor that removes leading whitespace from lines, except
+    inside fenced code blocks. Works in a single pass over each chunk and
+    carries the line and fence state across chunk boundaries, so the result
+    does not depend on how the stream was split.
+    """
 
-                if newline_index == -1:
-                    # No newline in the rest of the chunk - this is the end of a line or the whole chunk is a line part
-                    current_line_part = remaining_content
-                    remaining_content = ""  # Consume the rest
+    def __init__(self):
+        # Still inside the leading whitespace of the current line
+        self.leading = True
+        self.in_fence = False
+        # First (up to three) characters of the current line after its indentation
+        self.head = ""
+        # Past the head of the current line: text up to the next newline passes through
+        self.mid_line = False
 
-                    # Apply stripping only if this line part starts a new line conceptually
-                    if (
-                        last_char_was_newline
-                        and current_line_part.lstrip() != current_line_part
-                    ):
-                        processed_content_chunk += current_line_part.lstrip()
-                    else:
-                        processed_content_chunk += current_line_part
+    def feed(self, text: str) -> str:
+        # Lines the chunk completes go through _end_line, which feeds their
+        # text back through here without the newline
+        if "\n" in text:
+            lines, _, text = text.rpartition("\n")
+            if "\n" in lines:
+                ended = "".join([self._end_line(line) for line in lines.split("\n")])
+            else:
+                ended = self._end_line(lines)
+        elif self.mid_line:
+            # Most chunks are a few characters in the middle of a line
+            return text
+        else:
+            ended = ""
 
-                    last_char_was_newline = (
-                        False  # This chunk (or line part) did not end with a newline
-                    )
+        # What is left belongs to the current line
+        content = text
+        if self.leading:
+            if self.in_fence:
+                content = text.lstrip(" \t")
+            else:
+                text = content = text.lstrip()
+            if not content:
+                return ended + text
+            self.leading = False
 
-                else:
-                    # Found a newline - process the line up to and including the newline
-                    current_line = remaining_content[: newline_index + 1]
-                    remaining_content = remaining_content[
-                        newline_index + 1 :
-                    ]  # Rest after newline
+        # A line starting with a fence marker opens or closes a code block;
+        # the marker may arrive split over several chunks
+        if not self.mid_line:
+            self.head += content[: 3 - len(self.head)]
+            if self.head in FENCE_MARKERS:
+                self.in_fence = not self.in_fence
+            self.mid_line = len(self.head) >= 3
+        return ended + text
 
-                    # Apply stripping if this line starts a new line conceptually
-                    if last_char_was_newline and current_line.lstrip() != current_line:
-                        processed_content_chunk += current_line.lstrip()
-                    else:
-                        processed_content_chunk += current_line
+    def _end_line(self, text: str) -> str:
+        """Processes the rest of the current line and returns it with its newline."""
+        if not self.mid_line:
+            text = self.feed(text)
+            if self.leading and not self.in_fence:
+                # A blank line outside a code block is dropped with its newline
+                return ""
+        self.leading, self.head, self.mid_line = True, "", False
+        return text + "\n"
 
-                    last_char_was_newline = True  # This line ended with a newline
 
-            yield (
-                original_chunk,
-                processed_content_chunk,
-            )  # Yield original chunk and processed string content
+async def stream_with_indentation_fix(raw_chunk_iterator):
+    """
+    Async generator that processes chunks from a raw stream with an
+    IndentationFixer.
+    Yields tuples: (original_chunk, processed_string_content_or_original_non_string_chunk).
 
-            # The state `last_char_was_newline` is already updated within the while loop
-            # based on the last line processed in this chunk.
+    Args:
+        raw_chunk_iterator: An async iterator yielding chunks from an LLM stream
+                            (e.g., answer_chain.astream()).
 
-        else:
-            # If the chunk is not string content (e.g., tool call, metadata), yield it as is,
-            # paired with itself for the 'processed' item.
-            # How this affects newline state is ambiguous. Let's assume it doesn't change the state.
-            if original_chunk is not None:
-                yield (original_chunk, original_chunk)
-            # last_char_was_newline remains unchanged for non-string chunks
+    Yields:
+        tuple: A tuple containing (original_chunk, processed_item).
+               processed_item is the string content after potential stripping,
+               or the original_chunk if it wasn't string content.
+    """
+    fixer = IndentationFixer()
+    async for original_chunk in raw_chunk_iterator:
+        text = extract_chunk_text(original_chunk)
+        if text is not None:
+            yield (original_chunk, fixer.feed(text))
+        elif original_chunk is not None:
+            # Non-text chunks (tool calls, metadata) pass through and do not
+            # change the line state
+            yield (original_chunk, original_chunk)
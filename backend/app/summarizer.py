@@ -0,0 +1,81 @@
+import logging
+from typing import List
+
+from langchain_core.prompts import ChatPromptTemplate
+from langchain_openai import ChatOpenAI
+
+from .token_budget import message_tokens, select_history_window
+
+# Summarise once the messages not yet covered by the summary exceed this many
+# tokens, folding all but the most recent SUMMARY_KEEP_RECENT_TOKENS into it.
+# The trigger stays below the smallest history budget so the unsummarised
+# tail always fits the prompt.
+SUMMARY_TRIGGER_TOKENS = 3000
+SUMMARY_KEEP_RECENT_TOKENS = 1000
+SUMMARY_LOCK_SECONDS = 120
+
+SUMMARY_PROMPT = ChatPromptTemplate.from_template(
+    """You maintain a running summary of a conversation between a user and an AI assistant about a PDF document.
+Update the existing summary with the new conversation turns below.
+Keep facts, names, numbers, page citations and open questions the user may refer back to. Drop small talk.
+Keep the summary under 300 words and respond only with the updated summary.
+
+Existing summary:
+{summary}
+
+New conversation turns:
+{turns}"""
+)
+
+
+def format_turns(messages: List[dict]) -> str:
+    lines = []
+    for message in messages:
+        speaker = "User" if message.get("role") == "human" else "Assistant"
+        lines.append(f"{speaker}: {message.get('content', '')}")
+    return "\n".join(lines)
+
+
+async def summarize_turns(previous_summary: str, messages: List[dict]) -> str:
+    llm = ChatOpenAI(model="gpt-4o-mini", temperature=0)
+    chain = SUMMARY_PROMPT | llm
+    response = await chain.ainvoke(
+        {
+            "summary": previous_summary or "(none yet)",
+            "turns": format_turns(messages),
+        }
+    )
+    return response.content.strip()
+
+
+async def maybe_summarize_session(session_manager, redis_instance, chat_session_id: str):
+    """
+    Folds the oldest unsummarised turns of a session into its running summary
+    once they pass SUMMARY_TRIGGER_TOKENS. Meant to run as a background task
+    after a turn completes; a Redis lock keeps one summariser per session.
+    """
+    lock_key = f"summary_lock:{chat_session_id}"
+    if not await redis_instance.set(lock_key, 1, nx=True, ex=SUMMARY_LOCK_SECONDS):
+        return
+
+    try:
+        history = await session_manager.get_recent_messages(chat_session_id)
+        current = await session_manager.get_summary(chat_session_id)
+        # summary_upto is the sequence number of the last folded message
+        summary_upto = current.get("summary_upto", 0)
+
+        unsummarized = [m for m in history if m.get("seq", 0) > summary_upto]
+        if sum(message_tokens(m) for m in unsummarized) <= SUMMARY_TRIGGER_TOKENS:
+            return
+
+        recent = select_history_window(unsummarized, SUMMARY_KEEP_RECENT_TOKENS)
+        to_fold = unsummarized[: len(unsummarized) - len(recent)]
+        if not to_fold:
+            return
+
+        summary = await summarize_turns(current.get("summary", ""), to_fold)
+        await session_manager.set_summary(chat_session_id, summary, to_fold[-1]["seq"])
+    except Exception as e:
+        logging.error(f"❌ Failed to summarize session {chat_session_id}: {e}")
+    finally:
+        await redis_instance.delete(lock_key)
@@ -0,0 +1,73 @@
+import logging
+from typing import List, Optional
+
+try:
+    import tiktoken
+except ImportError:  # pragma: no cover - tiktoken ships with langchain-openai
+    tiktoken = None
+
+# Tokens of chat history sent to the main chain, per preferred model.
+# Models not listed here fall back to gpt-4o-mini, same as create_chain.
+MODEL_HISTORY_TOKEN_BUDGETS = {
+    "gemini-2.0": 6000,
+    "gpt-4o-mini": 4000,
+}
+DEFAULT_MODEL = "gpt-4o-mini"
+
+_encoding = None
+
+
+def load_encoding():
+    """
+    Loads the gpt-4o tokenizer. Blocking, as tiktoken downloads it on first
+    use, so the app calls it once at startup in a thread. Counts estimate
+    until it has loaded, and for good if loading failed.
+    """
+    global _encoding
+    if _encoding is not None or tiktoken is None:
+        return
+    try:
+        _encoding = tiktoken.get_encoding("o200k_base")
+    except Exception as e:
+        logging.warning(f"⚠️ Could not load tiktoken encoding, estimating: {e}")
+
+
+def count_tokens(text: str) -> int:
+    """Counts tokens with the gpt-4o tokenizer, or estimates ~4 chars per token."""
+    if not text:
+        return 0
+    encoding = _encoding
+    if encoding is None:
+        return len(text) // 4 + 1
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def message_tokens(message: dict) -> int:
+    """Returns the cached token count of a stored message, counting it if absent."""
+    tokens = message.get("tokens")
+    if tokens is None:
+        tokens = count_tokens(message.get("content", ""))
+    return int(tokens)
+
+
+def history_token_budget(model: Optional[str]) -> int:
+    return MODEL_HISTORY_TOKEN_BUDGETS.get(
+        model, MODEL_HISTORY_TOKEN_BUDGETS[DEFAULT_MODEL]
+    )
+
+
+def select_history_window(history: List[dict], budget: int) -> List[dict]:
+    """
+    Returns the most recent messages whose combined token count fits the budget.
+    Walks back from the end using cached per-message counts, so the cost is
+    proportional to the window rather than to the whole history.
+    """
+    total = 0
+    start = len(history)
+    while start > 0:
+        tokens = message_tokens(history[start - 1])
+        if total + tokens > budget:
+            break
+        total += tokens
+        start -= 1
+    return history[start:]
@@ -0,0 +1,84 @@
+import json
+import uuid
+from typing import List, Optional, Tuple
+
+# Every event of a chat turn is appended to a short-lived Redis Stream before
+# it is published, so a client that connects late or reconnects can replay
+# what it missed. SSE event IDs are "<turn_id>/<stream entry ID>".
+TURN_STREAM_KEY = "chat_turn_events:{}"
+TURN_STREAM_TTL_SECONDS = 300
+TURN_STREAM_MAXLEN = 5000
+
+# Appends the event to the turn's stream and publishes it with its event ID in
+# one round trip, so live and replayed events carry the same IDs. The publish
+# is skipped when the only subscriber is the publishing process itself
+# (ARGV[6] is 1 when it is subscribed), which delivers the event locally; the
+# origin tag lets it ignore its own events if they come back anyway.
+PUBLISH_TURN_EVENT_SCRIPT = """
+local entry_id = redis.call('XADD', KEYS[1], 'MAXLEN', '~', ARGV[4], '*', 'e', ARGV[1])
+redis.call('EXPIRE', KEYS[1], ARGV[5])
+local subscribers = redis.call('PUBSUB', 'NUMSUB', ARGV[2])[2]
+if subscribers > tonumber(ARGV[6]) then
+    local event = '{"id":"' .. ARGV[3] .. '/' .. entry_id .. '","o":"' .. ARGV[7] .. '",' .. string.sub(ARGV[1], 2)
+    redis.call('PUBLISH', ARGV[2], event)
+end
+return entry_id
+"""
+
+
+def new_turn_id() -> str:
+    return uuid.uuid4().hex
+
+
+def parse_event_id(event_id: Optional[str]) -> Optional[Tuple[str, str]]:
+    """Split an SSE event ID into (turn_id, entry_id), or None if it is not one of ours."""
+    if not event_id or "/" not in event_id:
+        return None
+    turn_id, entry_id = event_id.split("/", 1)
+    return (turn_id, entry_id) if turn_id and entry_id else None
+
+
+def entry_order(entry_id: str) -> Tuple[int, int]:
+    """Sort key of a stream entry ID ("<ms>-<seq>")."""
+    ms, _, seq = entry_id.partition("-")
+    return int(ms), int(seq or 0)
+
+
+async def publish_turn_event(
+    redis_instance,
+    channel: str,
+    turn_id: str,
+    payload: dict,
+    origin: str = "",
+    locally_subscribed: bool = False,
+) -> str:
+    """Record the event in the turn's stream and publish it on the channel; returns its entry ID."""
+    return await redis_instance.eval(
+        PUBLISH_TURN_EVENT_SCRIPT,
+        1,
+        TURN_STREAM_KEY.format(turn_id),
+        json.dumps(payload),
+        channel,
+        turn_id,
+        TURN_STREAM_MAXLEN,
+        TURN_STREAM_TTL_SECONDS,
+        int(locally_subscribed),
+        origin,
+    )
+
+
+async def read_turn_events(
+    redis_instance, turn_id: str, after_entry_id: str = "0-0"
+) -> List[dict]:
+    """Return the turn's recorded events after `after_entry_id`, each with its SSE event ID."""
+    entries = await redis_instance.xrange(
+        TURN_STREAM_KEY.format(turn_id), min=after_entry_id, max="+"
+    )
+    events = []
+    for entry_id, fields in entries:
+        if entry_id == after_entry_id:
+            continue
+        event = json.loads(fields["e"])
+        event["id"] = f"{turn_id}/{entry_id}"
+        events.append(event)
+    return events
@@ -9,11 +9,8 @@ security = HTTPBearer()
 JWT_SECRET = os.getenv("JWT_SECRET")
 
 
-async def get_current_user(
-    credentials: HTTPAuthorizationCredentials = Depends(security),
-):
-    token = credentials.credentials
-
+def decode_user_token(token: str) -> str:
+    """Return the user ID of a JWT access token, or raise a 401 HTTPException."""
     try:
         payload = jwt.decode(token, JWT_SECRET, algorithms=["HS256"])
         # Use 'id' instead of 'sub'
@@ -29,12 +26,18 @@ async def get_current_user(
             status_code=status.HTTP_401_UNAUTHORIZED, detail="Token has expired"
         )
     except jwt.InvalidTokenError as e:
-        logging.error("Token validation failed:", e)  # Log the error
+        logging.error(f"Token validation failed: {e}")  # Log the error
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid token"
         )
 
 
+async def get_current_user(
+    credentials: HTTPAuthorizationCredentials = Depends(security),
+):
+    return decode_user_token(credentials.credentials)
+
+
 async def verify_token(token: str):
     try:
         payload = jwt.decode(token, JWT_SECRET, algorithms=["HS256"])
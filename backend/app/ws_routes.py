@@ -0,0 +1,333 @@
+# ws_routes.py
+
+from fastapi import APIRouter, HTTPException, WebSocket, WebSocketDisconnect, status
+from pydantic import ValidationError
+import asyncio
+import json
+import logging
+import time
+from typing import Dict, Optional, Tuple
+
+from .metrics import WS_CONNECTIONS, WS_SUBSCRIPTIONS_DROPPED
+from .pubsub_multiplexer import STREAM_OVERFLOW
+from .routes import MessageRequest, iter_session_events, start_chat_turn
+from .turn_stream import parse_event_id
+from .verify_access import decode_user_token
+
+# One WebSocket carries the sends and streams of any number of chat sessions,
+# replacing a /chat_send request plus an SSE connection per tab. Frames are
+# compact JSON objects with a "type":
+#
+#   client -> server
+#     {"type": "auth", "token": ...}   first frame, unless ?token= was given
+#     {"type": "send", "ref": ..., <MessageRequest fields>}
+#     {"type": "subscribe", "chat_session_id": ...,
+#      "turn_id": ..., "last_event_id": ...}
+#     {"type": "unsubscribe", "chat_session_id": ...}
+#     {"type": "ping"}
+#
+#   server -> client
+#     {"type": "ack", "ref": ..., "code": ..., <chat_send response>}
+#     {"s": <chat_session_id>, "id": ..., "type": ..., ...}  a chat_stream event
+#     {"type": "error", "ref" | "s": ..., "content": ...}
+#     {"type": "pong"}
+#
+# A send subscribes the socket to its session and replays the turn from its
+# start; "subscribe" resumes a session after its last event ID.
+
+WS_AUTH_TIMEOUT_SECONDS = 10
+# Also passed to the server as ws_max_size, so larger frames are refused
+# before they are read into memory
+WS_MAX_FRAME_BYTES = 64 * 1024
+WS_MAX_SUBSCRIPTIONS = 32
+# Same budget as /chat_send, counted per user in Redis so opening more
+# sockets, or reaching another worker, does not add to it
+WS_SENDS_PER_MINUTE = 30
+WS_SEND_LIMIT_KEY = "ws_send_limit:{}:{}"
+# Frames waiting for the socket. Session streams block once it is full, so a
+# slow client backs up into its multiplexer queues, which drop the session
+# (the client resubscribes from its last event ID) instead of buffering.
+WS_OUTBOUND_QUEUE_SIZE = 256
+
+TOO_MANY_SESSIONS = "Too many sessions on this socket"
+
+ws_router = APIRouter()
+
+
+def encode_frame(frame: dict) -> str:
+    return json.dumps(frame, separators=(",", ":"))
+
+
+class ChatSocket:
+    """An authenticated chat WebSocket: its session subscriptions and outbound queue."""
+
+    def __init__(self, websocket: WebSocket, user_id: str):
+        self.websocket = websocket
+        self.user_id = user_id
+        self.app_state = websocket.app.state
+        self.outbound: asyncio.Queue = asyncio.Queue(maxsize=WS_OUTBOUND_QUEUE_SIZE)
+        # chat_session_id -> (multiplexer queue, forwarding task)
+        self.subscriptions: Dict[str, Tuple[asyncio.Queue, asyncio.Task]] = {}
+
+    async def reader(self):
+        while True:
+            text = await self.websocket.receive_text()
+            try:
+                if len(text.encode("utf-8")) > WS_MAX_FRAME_BYTES:
+                    raise ValueError("Frame too large")
+                frame = json.loads(text)
+                if not isinstance(frame, dict):
+                    raise ValueError("Frame is not an object")
+            except ValueError as e:
+                await self.outbound.put({"type": "error", "content": str(e)})
+                continue
+            try:
+                await self.handle(frame)
+            except Exception as e:
+                # A failed frame costs only its reply, as a failed request
+                # would over HTTP, not the other streams on the socket
+                logging.exception(
+                    f"❌ WebSocket {frame.get('type')} frame failed "
+                    f"for user {self.user_id}: {e}"
+                )
+                error = {"type": "error", "content": "Internal server error"}
+                if frame.get("type") == "send":
+                    error["ref"] = frame.get("ref")
+                elif isinstance(frame.get("chat_session_id"), str):
+                    error["s"] = frame["chat_session_id"]
+                await self.outbound.put(error)
+
+    async def writer(self):
+        while True:
+            frame = await self.outbound.get()
+            await self.websocket.send_text(encode_frame(frame))
+
+    async def run(self):
+        """
+        Reads and writes until either side stops. A failed send ends the
+        socket as a disconnect does, instead of leaving the reader blocked
+        on a full outbound queue.
+        """
+        reader = asyncio.create_task(self.reader())
+        writer = asyncio.create_task(self.writer())
+        try:
+            done, _ = await asyncio.wait(
+                {reader, writer}, return_when=asyncio.FIRST_COMPLETED
+            )
+            # Raise whatever stopped it, usually WebSocketDisconnect
+            for task in done:
+                task.result()
+        finally:
+            reader.cancel()
+            writer.cancel()
+            for chat_session_id in list(self.subscriptions):
+                await self.unsubscribe(chat_session_id)
+
+    async def handle(self, frame: dict):
+        frame_type = frame.get("type")
+        if frame_type == "send":
+            await self.send_message(frame)
+        elif frame_type == "subscribe":
+            chat_session_id = frame.get("chat_session_id")
+            if not isinstance(chat_session_id, str) or not chat_session_id:
+                await self.outbound.put(
+                    {"type": "error", "content": "Missing chat_session_id"}
+                )
+                return
+            if not await self.owns_session(chat_session_id):
+                await self.outbound.put(
+                    {
+                        "type": "error",
+                        "s": chat_session_id,
+                        "content": "Session not found",
+                    }
+                )
+                return
+            # Resubscribing replaces the current stream of the session
+            await self.unsubscribe(chat_session_id)
+            resume = parse_event_id(frame.get("last_event_id"))
+            replay_turn, replayed_upto = resume or (frame.get("turn_id"), "0-0")
+            await self.subscribe(chat_session_id, replay_turn, replayed_upto)
+        elif frame_type == "unsubscribe":
+            await self.unsubscribe(frame.get("chat_session_id"))
+        elif frame_type == "ping":
+            await self.outbound.put({"type": "pong"})
+        else:
+            await self.outbound.put(
+                {"type": "error", "content": f"Unknown frame type: {frame_type}"}
+            )
+
+    async def within_send_limit(self) -> bool:
+        """Count a send against the user's budget for the current minute."""
+        key = WS_SEND_LIMIT_KEY.format(self.user_id, int(time.time() // 60))
+        async with self.app_state.redis_instance.pipeline(transaction=True) as pipe:
+            pipe.incr(key)
+            pipe.expire(key, 60)
+            sends, _ = await pipe.execute()
+        return sends <= WS_SENDS_PER_MINUTE
+
+    async def send_message(self, frame: dict):
+        ref = frame.get("ref")
+        if not await self.within_send_limit():
+            await self.outbound.put(
+                {"type": "error", "ref": ref, "content": "Rate limit exceeded"}
+            )
+            return
+
+        try:
+            message_request = MessageRequest(
+                **{k: v for k, v in frame.items() if k not in ("type", "ref")}
+            )
+        except (ValidationError, TypeError) as e:
+            await self.outbound.put(
+                {"type": "error", "ref": ref, "content": f"Invalid message: {e}"}
+            )
+            return
+
+        chat_session_id = message_request.chat_session_id
+        if (
+            chat_session_id not in self.subscriptions
+            and len(self.subscriptions) >= WS_MAX_SUBSCRIPTIONS
+        ):
+            await self.outbound.put(
+                {"type": "error", "ref": ref, "content": TOO_MANY_SESSIONS}
+            )
+            return
+
+        try:
+            code, content = await start_chat_turn(
+                self.app_state, message_request, self.user_id
+            )
+        except HTTPException as e:
+            code, content = e.status_code, {"error": e.detail}
+
+        if code == status.HTTP_200_OK and chat_session_id not in self.subscriptions:
+            # Replaying from the start of the turn covers events published
+            # before the subscription was made
+            await self.subscribe(chat_session_id, content["turn_id"], "0-0")
+        await self.outbound.put({"type": "ack", "ref": ref, "code": code, **content})
+
+    async def owns_session(self, chat_session_id: str) -> bool:
+        session_manager = self.app_state.session_manager_firebase
+        if session_manager is None:
+            return False
+        # A session still being created is reserved for its creator by chat_send
+        owner = await session_manager.get_session_owner(chat_session_id)
+        return owner == self.user_id
+
+    async def subscribe(
+        self, chat_session_id: str, replay_turn: Optional[str], replayed_upto: str
+    ):
+        if len(self.subscriptions) >= WS_MAX_SUBSCRIPTIONS:
+            await self.outbound.put(
+                {"type": "error", "s": chat_session_id, "content": TOO_MANY_SESSIONS}
+            )
+            return
+        multiplexer = self.app_state.pubsub_multiplexer
+        # Subscribe before replaying so no event falls between the two
+        queue = await multiplexer.subscribe(f"chat:{chat_session_id}")
+        task = asyncio.create_task(
+            self.forward(chat_session_id, queue, replay_turn, replayed_upto)
+        )
+        self.subscriptions[chat_session_id] = (queue, task)
+
+    async def unsubscribe(self, chat_session_id: Optional[str]):
+        subscription = self.subscriptions.pop(chat_session_id, None)
+        if subscription is None:
+            return
+        queue, task = subscription
+        if task is not asyncio.current_task():
+            task.cancel()
+        try:
+            await self.app_state.pubsub_multiplexer.unsubscribe(
+                f"chat:{chat_session_id}", queue
+            )
+        except Exception as e:
+            logging.error(f"Cleanup error: {e}")
+
+    async def forward(
+        self,
+        chat_session_id: str,
+        queue: asyncio.Queue,
+        replay_turn: Optional[str],
+        replayed_upto: str,
+    ):
+        """Copies the session's events to the outbound queue until unsubscribed."""
+        try:
+            async for data in iter_session_events(
+                self.app_state.redis_instance, queue, replay_turn, replayed_upto
+            ):
+                if data is STREAM_OVERFLOW:
+                    WS_SUBSCRIPTIONS_DROPPED.inc()
+                    await self.outbound.put(
+                        {
+                            "type": "error",
+                            "s": chat_session_id,
+                            "content": "Stream fell behind, please resubscribe",
+                        }
+                    )
+                    break
+                await self.outbound.put({"s": chat_session_id, **data})
+        except asyncio.CancelledError:
+            return
+        except Exception as e:
+            logging.error(f"WebSocket stream error for {chat_session_id}: {e}")
+        # Dropped or failed: release the subscription unless it was replaced
+        if self.subscriptions.get(chat_session_id, (None,))[0] is queue:
+            await self.unsubscribe(chat_session_id)
+
+
+async def authenticate(websocket: WebSocket, token: Optional[str]) -> str:
+    """Return the user ID from the ?token= query or the first frame."""
+    if not token:
+        try:
+            frame = json.loads(
+                await asyncio.wait_for(
+                    websocket.receive_text(), WS_AUTH_TIMEOUT_SECONDS
+                )
+            )
+        except (asyncio.TimeoutError, ValueError):
+            frame = None
+        if not isinstance(frame, dict) or frame.get("type") != "auth":
+            raise HTTPException(
+                status_code=status.HTTP_401_UNAUTHORIZED, detail="Token missing"
+            )
+        token = frame.get("token")
+    if not isinstance(token, str) or not token:
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED, detail="Token missing"
+        )
+    return decode_user_token(token)
+
+
+@ws_router.websocket("/ws")
+async def chat_socket(websocket: WebSocket, token: Optional[str] = None):
+    """
+    Chat transport multiplexing the sends and streams of many sessions over
+    one connection, authenticated once when it opens.
+    """
+    await websocket.accept()
+    try:
+        user_id = await authenticate(websocket, token)
+    except HTTPException as e:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION, reason=e.detail)
+        return
+    except WebSocketDisconnect:
+        return
+
+    if websocket.app.state.redis_instance is None:
+        await websocket.close(
+            code=status.WS_1011_INTERNAL_ERROR, reason="Redis unavailable"
+        )
+        return
+
+    logging.info(f"🔌 WebSocket opened for user {user_id}")
+    WS_CONNECTIONS.inc()
+    try:
+        await ChatSocket(websocket, user_id).run()
+    except WebSocketDisconnect:
+        logging.info(f"🔌 WebSocket closed for user {user_id}")
+    except Exception as e:
+        logging.error(f"❌ WebSocket error for user {user_id}: {e}")
+    finally:
+        WS_CONNECTIONS.dec()
@@ -0,0 +1,121 @@
+"""
+Micro-benchmark for the streaming indentation post-processor. Feeds the same
+answer through IndentationFixer under adversarial chunk splits (one character
+per chunk, splits inside fence markers and indentation, one huge chunk) and
+compares it with the previous line-by-line implementation, which rebuilt its
+output with string concatenation. Also checks that the output does not depend
+on how the stream was split.
+
+Usage: python bench_stream_postprocessor.py [repeats]  (default 50; fewer runs are noisy)
+"""
+
+import random
+import sys
+import time
+
+from app.stream_with_indentation_fix import IndentationFixer
+
+SECTION = (
+    "  Here is the summary of page 3:\n\n"
+    "   - The first point\n"
+    "   - The second point\n"
+    "  ```python\n"
+    "    def area(r):\n"
+    "        return 3.14159 * r * r\n"
+    "\n"
+    "  ```\n"
+    "    Indented prose after the block.\n"
+)
+ANSWER = SECTION * 200
+
+
+class LegacyFixer:
+    """The previous per-line implementation, kept for comparison."""
+
+    def __init__(self):
+        self.last_char_was_newline = True
+
+    def feed(self, text: str) -> str:
+        processed = ""
+        remaining = text
+        while remaining:
+            newline_index = remaining.find("\n")
+            if newline_index == -1:
+                part, remaining = remaining, ""
+                ends_line = False
+            else:
+                part = remaining[: newline_index + 1]
+                remaining = remaining[newline_index + 1 :]
+                ends_line = True
+            if self.last_char_was_newline and part.lstrip() != part:
+                processed += part.lstrip()
+            else:
+                processed += part
+            self.last_char_was_newline = ends_line
+        return processed
+
+
+def split_every(text, size):
+    return [text[i : i + size] for i in range(0, len(text), size)]
+
+
+def split_on_markers(text):
+    """Cuts inside every fence marker and every run of indentation."""
+    cuts = set()
+    for i in range(1, len(text)):
+        if text[i - 1 : i + 1] in ("``", "  ") or text[i - 1] == "\n":
+            cuts.add(i)
+    bounds = [0] + sorted(cuts) + [len(text)]
+    return [text[a:b] for a, b in zip(bounds, bounds[1:])]
+
+
+def split_random(text, seed=7):
+    rng = random.Random(seed)
+    chunks, pos = [], 0
+    while pos < len(text):
+        size = rng.randint(1, 12)
+        chunks.append(text[pos : pos + size])
+        pos += size
+    return chunks
+
+
+SPLITS = {
+    "one char per chunk": lambda t: split_every(t, 1),
+    "cut inside markers": split_on_markers,
+    "random 1-12 chars": split_random,
+    "token-sized (4)": lambda t: split_every(t, 4),
+    "single chunk": lambda t: [t],
+}
+
+
+def run(fixer_cls, chunks):
+    fixer = fixer_cls()
+    return "".join(fixer.feed(chunk) for chunk in chunks)
+
+
+def bench(fixer_cls, chunks, repeats):
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        run(fixer_cls, chunks)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    expected = run(IndentationFixer, [ANSWER])
+
+    print(f"answer: {len(ANSWER)} chars, best of {repeats}")
+    print(f"{'split':<22}{'chunks':>8}{'fixer ms':>12}{'legacy ms':>12}")
+    for name, split in SPLITS.items():
+        chunks = split(ANSWER)
+        if run(IndentationFixer, chunks) != expected:
+            raise AssertionError(f"output depends on the split: {name}")
+        fixer_ms = bench(IndentationFixer, chunks, repeats) * 1000
+        legacy_ms = bench(LegacyFixer, chunks, repeats) * 1000
+        print(f"{name:<22}{len(chunks):>8}{fixer_ms:>12.2f}{legacy_ms:>12.2f}")
+
+
+if __name__ == "__main__":
+    main()
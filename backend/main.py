@@ -12,10 +12,16 @@ log_level = os.getenv("LOG_LEVEL", "INFO").upper()
 
 logging.basicConfig(
     level=log_level,
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+    format="%(asctime)s - %(name)s - %(levelname)s - [%(request_id)s] %(message)s",
     force=True,  # Override existing configurations
 )
 
+# Tag every record with the request ID before anything else logs
+from app.metrics import RequestIdFilter
+
+for handler in logging.getLogger().handlers:
+    handler.addFilter(RequestIdFilter())
+
 # Suppress DEBUG logs from third-party libraries
 logging.getLogger("pinecone").setLevel(logging.WARNING)
 logging.getLogger("pinecone_plugin_interface").setLevel(logging.WARNING)
@@ -29,12 +35,16 @@ logging.info("🚀 Logging is set up globally!")
 from app.db import lifespan
 from app.routes import router
 from app.demo_routes import demo_router
+from app.ws_routes import WS_MAX_FRAME_BYTES, ws_router
+from app.metrics import RequestIdMiddleware, metrics_router
 
 allowed_origins = os.getenv("ALLOWED_ORIGINS")
 
 app = FastAPI(lifespan=lifespan)
 app.include_router(router)
 app.include_router(demo_router)
+app.include_router(ws_router)
+app.include_router(metrics_router)
 
 
 app.add_middleware(
@@ -43,7 +53,9 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Request-ID", "ETag"],
 )
+app.add_middleware(RequestIdMiddleware)
 
 
 @app.exception_handler(RequestValidationError)
@@ -65,5 +77,6 @@ if __name__ == "__main__":
         app,
         host="0.0.0.0",
         port=int(os.getenv("PORT", 8000)),
+        ws_max_size=WS_MAX_FRAME_BYTES,
         log_config=None,  # Prevent Uvicorn from overriding your config
     )
@@ -0,0 +1,50 @@
+"""
+One-off migration that moves the `chat_history` array of every session document
+into the `sessions/{id}/messages` subcollection. Sessions that are opened before
+this runs are migrated lazily when their history is first cached, so the script
+only needs to catch up on the rest. Safe to re-run.
+
+Usage: python migrate_session_messages.py
+"""
+
+import asyncio
+import logging
+
+from dotenv import load_dotenv
+
+load_dotenv()
+logging.basicConfig(
+    level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s"
+)
+
+from app.db import firestore_dal  # noqa: E402
+
+PAGE_SIZE = 100
+
+
+async def migrate_all_sessions():
+    if firestore_dal is None:
+        raise RuntimeError("Firestore is not configured")
+
+    migrated = 0
+    last_doc = None
+    while True:
+        query = firestore_dal.db.collection("sessions").order_by("__name__")
+        if last_doc is not None:
+            query = query.start_after(last_doc)
+        docs = await firestore_dal.run(query.limit(PAGE_SIZE).get)
+        if not docs:
+            break
+
+        for doc in docs:
+            session_dict = doc.to_dict()
+            if "chat_history" in session_dict:
+                await firestore_dal.migrate_session_messages(doc.id, session_dict)
+                migrated += 1
+        last_doc = docs[-1]
+
+    logging.info(f"✅ Migrated {migrated} sessions to the messages subcollection")
+
+
+if __name__ == "__main__":
+    asyncio.run(migrate_all_sessions())
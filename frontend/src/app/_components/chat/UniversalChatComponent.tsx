@@ -64,6 +64,10 @@ const UniversalChatComponent: React.FC<UniversalChatComponentProps> = ({
     setRetrievalMethod,
     resetDemoState,
     updateMessagesFromHistory,
+    loadChatHistory,
+    loadOlderMessages,
+    olderMessagesCursor,
+    isHistoryLoading,
     addNewChatSession, // Added action
   } = useAppStore();
 
@@ -102,14 +106,15 @@ const UniversalChatComponent: React.FC<UniversalChatComponentProps> = ({
     }
   }, [message]);
 
-  // Scroll to bottom
+  // Scroll to bottom; earlier pages prepended above do not move the view
+  const lastMessage = messages[messages.length - 1];
   useEffect(() => {
     // Delay scroll slightly to allow layout updates after streaming/loading state changes
     const timer = setTimeout(() => {
       messagesEndRef.current?.scrollIntoView({ behavior: "smooth" });
     }, 50); // Adjust delay as needed
     return () => clearTimeout(timer);
-  }, [messages, streamingAiResponse, isChatLoading]); // Trigger on loading state too
+  }, [lastMessage, streamingAiResponse, isChatLoading]); // Trigger on loading state too
 
   // PDF Toggle Keybind
   useEffect(() => {
@@ -255,7 +260,7 @@ const UniversalChatComponent: React.FC<UniversalChatComponentProps> = ({
     const pdf = pdfOptions.find((p) => p.pdfId === chat?.latest_pdfId); // Find associated PDF
     if (chat) {
       setCurrentChat(chat);
-      updateMessagesFromHistory(chat.chat_history || []); // Load history
+      loadChatHistory(chat.chat_session_id); // Load the latest page of history
       setCurrentPdf(pdf || null); // Set the associated PDF, or null if not found/set
       setError(null); // Clear error on selection change
       setStreamingAiResponse(""); // Clear any pending stream
@@ -362,18 +367,31 @@ const UniversalChatComponent: React.FC<UniversalChatComponentProps> = ({
               )}
             </div>
           ) : (
-            [...messages].map(
-              (
-                msg,
-                index // Iterate over a copy
-              ) => (
-                <ChatMessage
-                  key={`${msg.role}-${index}-${msg.pdfId}`}
-                  message={msg}
-                  index={index}
-                />
-              )
-            )
+            <>
+              {!isDemo && olderMessagesCursor && (
+                <Button
+                  variant="ghost"
+                  size="sm"
+                  className="self-center text-blue-600"
+                  disabled={isHistoryLoading}
+                  onClick={() => loadOlderMessages()}
+                >
+                  {isHistoryLoading ? "Loading..." : "Load earlier messages"}
+                </Button>
+              )}
+              {[...messages].map(
+                (
+                  msg,
+                  index // Iterate over a copy
+                ) => (
+                  <ChatMessage
+                    key={`${msg.role}-${index}-${msg.pdfId}`}
+                    message={msg}
+                    index={index}
+                  />
+                )
+              )}
+            </>
           )}
           <ChatLoadingOrStreaming
             isChatLoading={isChatLoading}
@@ -43,7 +43,8 @@ export interface ChatMessage {
 
 export interface ChatSession {
   chat_session_id: string;
-  chat_history: ChatMessage[];
+  // Only set on sessions created in this tab; saved messages are loaded with loadChatHistory
+  chat_history?: ChatMessage[];
   last_activity: Date | null;
   latest_pdfId: string;
   title: string;
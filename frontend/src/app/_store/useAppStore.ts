@@ -2,11 +2,33 @@ import axios from "axios";
 import { create } from "zustand";
 import { ChatMessage, ChatSession, PDFDocument } from "../_global/interface";
 
+// Messages fetched per page when a session is opened or scrolled back
+const HISTORY_PAGE_SIZE = 50;
+
+const fetchMessagePage = async (sessionId: string, before: number | null) => {
+  const tokenResponse = await fetch("/api/auth/get-token");
+  const { token } = await tokenResponse.json();
+  const response = await axios.get(
+    `${process.env.NEXT_PUBLIC_CHAT_ENDPOINT}/sessions/${sessionId}/messages`,
+    {
+      params: { limit: HISTORY_PAGE_SIZE, ...(before ? { before } : {}) },
+      headers: { Authorization: `Bearer ${token}` },
+    }
+  );
+  return response.data as {
+    messages: ChatMessage[];
+    next_cursor: number | null;
+  };
+};
+
 interface AppStoreState {
   // Chat State
   messages: ChatMessage[];
   chatData: string;
   isChatLoading: boolean;
+  isHistoryLoading: boolean;
+  // Cursor of the next older page of the open session, null once it is fully loaded
+  olderMessagesCursor: number | null;
   currentPdfId: string | null;
   currentChatId: string | null;
 
@@ -32,6 +54,8 @@ interface AppStoreState {
   setChatData: (data: string) => void;
   setChatLoading: (loading: boolean) => void;
   updateMessagesFromHistory: (history: ChatMessage[]) => void;
+  loadChatHistory: (sessionId: string) => Promise<void>;
+  loadOlderMessages: () => Promise<void>;
   updateChatTitle: (sessionId: string, newTitle: string) => void;
 
   // Selection Actions
@@ -53,10 +77,12 @@ interface AppStoreState {
   setOpenSummary: (open: boolean) => void;
 }
 
-export const useAppStore = create<AppStoreState>((set) => ({
+export const useAppStore = create<AppStoreState>((set, get) => ({
   messages: [],
   chatData: "",
   isChatLoading: false,
+  isHistoryLoading: false,
+  olderMessagesCursor: null,
   currentPdfId: null,
   currentChatId: null,
   selectedPdf: null,
@@ -91,7 +117,38 @@ export const useAppStore = create<AppStoreState>((set) => ({
     }),
   setChatData: (data) => set({ chatData: data }),
   setChatLoading: (loading) => set({ isChatLoading: loading }),
-  updateMessagesFromHistory: (history) => set({ messages: history }),
+  updateMessagesFromHistory: (history) =>
+    set({ messages: history, olderMessagesCursor: null }),
+  loadChatHistory: async (sessionId) => {
+    set({ messages: [], olderMessagesCursor: null, isHistoryLoading: true });
+    try {
+      const page = await fetchMessagePage(sessionId, null);
+      // Ignore the answer if another session was opened meanwhile
+      if (get().currentChatId !== sessionId) return;
+      set({ messages: page.messages, olderMessagesCursor: page.next_cursor });
+    } catch (err) {
+      set({ error: "Failed to load chat history" });
+    } finally {
+      set({ isHistoryLoading: false });
+    }
+  },
+  loadOlderMessages: async () => {
+    const { currentChatId, olderMessagesCursor, isHistoryLoading } = get();
+    if (!currentChatId || !olderMessagesCursor || isHistoryLoading) return;
+    set({ isHistoryLoading: true });
+    try {
+      const page = await fetchMessagePage(currentChatId, olderMessagesCursor);
+      if (get().currentChatId !== currentChatId) return;
+      set((state) => ({
+        messages: [...page.messages, ...state.messages],
+        olderMessagesCursor: page.next_cursor,
+      }));
+    } catch (err) {
+      set({ error: "Failed to load earlier messages" });
+    } finally {
+      set({ isHistoryLoading: false });
+    }
+  },
   updateChatTitle: (sessionId, newTitle) =>
     set((state) => ({
       chatOptions: state.chatOptions.map((chat) =>
@@ -22,6 +22,8 @@ export async function POST(request: NextRequest) {
       );
     }
 
+    // Only summary fields are listed; a session's messages are loaded page by
+    // page from the chat backend when it is opened
     const chatSessions = sessionsSnapshot.docs.map((doc) => {
       const data = doc.data();
       const lastActivity = data.last_activity
@@ -30,7 +32,6 @@ export async function POST(request: NextRequest) {
 
       return {
         chat_session_id: doc.id,
-        chat_history: data.chat_history || [],
         last_activity: lastActivity, // Send as JavaScript Date
         latest_pdfId: data.latest_pdfId || null,
         title: data.title || null,
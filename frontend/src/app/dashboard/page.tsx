@@ -125,7 +125,7 @@ const DashboardPage = () => {
     updateChatTitle,
     selectedPdf,
     isLoadingOptions,
-    updateMessagesFromHistory,
+    loadChatHistory,
   } = useAppStore();
   const { userId } = useAuthStore();
   const router = useRouter();
@@ -195,7 +195,7 @@ const DashboardPage = () => {
 
   const handleContinueChat = (chat: ChatSession) => {
     setCurrentChat(chat);
-    updateMessagesFromHistory(chat.chat_history);
+    loadChatHistory(chat.chat_session_id);
     const associatedPdf = pdfOptions?.find(
       (pdf) => pdf.pdfId === chat.latest_pdfId
     );
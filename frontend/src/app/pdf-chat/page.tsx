@@ -91,16 +91,12 @@ const PdfChatPage = () => {
           { headers: headers }
         );
 
-        if (res.data?.new_title) {
-          updateChatTitleAction(sessionIdToUse, res.data.new_title);
-        } else {
-        }
-
         if (isNewSessionForThisRequest) {
           markSessionAsNotNewAction(sessionIdToUse);
         }
 
-        const streamUrl = `${process.env.NEXT_PUBLIC_CHAT_ENDPOINT}/chat_stream/${sessionIdToUse}`;
+        // The turn ID lets the stream replay events sent before it connected
+        const streamUrl = `${process.env.NEXT_PUBLIC_CHAT_ENDPOINT}/chat_stream/${sessionIdToUse}?turn_id=${res.data.turn_id}`;
         eventSource = new EventSource(streamUrl);
 
         let botResponse = "";
@@ -110,6 +106,9 @@ const PdfChatPage = () => {
             if (data.type === "chunk" && data.content) {
               botResponse += data.content; // Convert back for internal state if needed
               streamHandlers.onChunkReceived(data.content); // Pass content with <br>
+            } else if (data.type === "title" && data.content) {
+              // Title is generated in the background for new sessions
+              updateChatTitleAction(sessionIdToUse, data.content);
             } else if (data.type === "error") {
               console.error("Received error from stream:", data.content);
               streamHandlers.onStreamError(
@@ -146,6 +145,11 @@ const PdfChatPage = () => {
 
         // Standard onerror handler
         eventSource.onerror = (errorEvent) => {
+          // The browser reconnects on its own and resumes from Last-Event-ID
+          if (eventSource?.readyState === EventSource.CONNECTING) {
+            console.warn(`EventSource reconnecting for session ${sessionIdToUse}`);
+            return;
+          }
           console.error(
             `EventSource error for session ${sessionIdToUse}:`,
             errorEvent